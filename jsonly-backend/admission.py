@@ -0,0 +1,125 @@
+from contextlib import asynccontextmanager
+from decouple import config
+import asyncio
+import logging
+import resource
+from cpu_pool import WEB_CONCURRENCY, worker_pids
+
+
+logger = logging.getLogger(__name__)
+
+# Memory this worker process and its CPU pool processes may use (RSS). fly.toml
+# gives the whole machine 1 GB, which is shared between the uvicorn workers.
+MEMORY_BUDGET_MB = config('MEMORY_BUDGET_MB', default=700 // max(1, WEB_CONCURRENCY), cast=int)
+# Memory used by a job per byte of PDF: the bytes read for the model, the
+# request body built from them (base64) and the PDF parsing
+UPLOAD_MEMORY_FACTOR = config('UPLOAD_MEMORY_FACTOR', default=4.0, cast=float)
+# Fixed overhead of a job (generated model, response objects, ...)
+JOB_OVERHEAD_MB = config('JOB_OVERHEAD_MB', default=20, cast=int)
+# Memory used by a job per byte of its JSON result
+RESULT_MEMORY_FACTOR = config('RESULT_MEMORY_FACTOR', default=3.0, cast=float)
+
+_MB = 1024 * 1024
+
+_reserved = 0
+_running = 0
+_baseline_rss = None
+_result_size = 64 * 1024  # running average of the result sizes, in bytes
+_condition: asyncio.Condition | None = None
+
+
+def _process_rss(pid: str | int) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def current_rss() -> int:
+    '''
+    Returns: resident memory of this process in bytes
+    '''
+    try:
+        return _process_rss("self")
+    except OSError:
+        # not Linux: peak RSS is the best available figure (KB on Linux, bytes on macOS)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def pool_rss() -> int:
+    '''
+    Returns: resident memory of the CPU pool processes in bytes
+    '''
+    total = 0
+    for pid in worker_pids():
+        try:
+            total += _process_rss(pid)
+        except OSError:
+            # exited, or not Linux
+            pass
+    return total
+
+
+def estimate(upload_size: int) -> int:
+    '''
+    Returns: the memory in bytes a job on a PDF of upload_size bytes is expected to use
+    '''
+    return int(upload_size * UPLOAD_MEMORY_FACTOR + _result_size * RESULT_MEMORY_FACTOR + JOB_OVERHEAD_MB * _MB)
+
+
+def record_result_size(size: int):
+    global _result_size
+    _result_size = int(0.9 * _result_size + 0.1 * size)
+
+
+def _projected(needed: int) -> int:
+    # the current RSS is not used: freed memory is rarely returned to the OS, so it stays
+    # near its peak after a burst and would hold back every job from then on
+    return _baseline_rss + _reserved + needed
+
+
+@asynccontextmanager
+async def reserve(upload_size: int):
+    '''
+    Waits until a job on a PDF of upload_size bytes fits in the memory budget,
+    and holds its reservation while the job runs. A job always starts when
+    nothing else is running, even if it exceeds the budget on its own.
+    '''
+    global _reserved, _running, _baseline_rss, _condition
+    if _condition is None:
+        _condition = asyncio.Condition()
+
+    needed = estimate(upload_size)
+    budget = MEMORY_BUDGET_MB * _MB
+    async with _condition:
+        if not _running:
+            # memory in use without any job: this process and its CPU pool
+            _baseline_rss = current_rss() + pool_rss()
+        if _running and _projected(needed) > budget:
+            logger.info(
+                f"Job of {needed // _MB} MB waiting for memory "
+                f"({_running} running, {_reserved // _MB} MB reserved)"
+            )
+            await _condition.wait_for(lambda: not _running or _projected(needed) <= budget)
+        _reserved += needed
+        _running += 1
+
+    try:
+        yield
+    finally:
+        async with _condition:
+            _reserved -= needed
+            _running -= 1
+            if not _running:
+                _baseline_rss = current_rss() + pool_rss()
+            _condition.notify_all()
+
+
+def get_stats() -> dict:
+    return {
+        "budget_mb": MEMORY_BUDGET_MB,
+        "rss_mb": current_rss() // _MB,
+        "pool_rss_mb": pool_rss() // _MB,
+        "baseline_mb": (_baseline_rss or 0) // _MB,
+        "reserved_mb": _reserved // _MB,
+        "running_jobs": _running,
+        "average_result_kb": _result_size // 1024,
+    }
@@ -1,20 +1,33 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, Body
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, Body, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 import os
-from structure import ai_harmonize_templates, ai_extract
-import PyPDF2
+from structure import ai_harmonize_templates, ai_extract, ai_extract_many, get_client, close_client
+from cpu_pool import start_pool, shutdown_pool, run_cpu, run_cpu_sync, hash_secret, check_secret, count_pdf_pages, WEB_CONCURRENCY
+import task_store
+import webhooks
+import uploads
+import export
+import admission
+import http_pool
+import routing
+import hedging
+import fast_json
+from templates import Template
 import base64
-import bcrypt
+import secrets
 import uuid
-import httpx
-from typing import List, Dict, Any
-from decouple import config
+from typing import List, Dict, Any, Literal
+from datetime import datetime
+from decouple import config, Csv
 from contextlib import asynccontextmanager
 import asyncio
 import uuid
 import uvicorn
 from pathlib import Path
 import json
+import shutil
+import time
 
 
 # Firebase Admin SDK imports
@@ -27,12 +40,43 @@ VALID_CLIENTS = {
     "partner_backend": "secure_token_123"
 }
 
-SERVER_URL = config('SERVER_URL', default='https://jsonly-backend.fly.dev')
+TASK_SWEEP_INTERVAL = config('TASK_SWEEP_INTERVAL', default=3600, cast=int)
+# Firebase uids of the users allowed to read the operational endpoints (/model-stats)
+ADMIN_UIDS = set(config('ADMIN_UIDS', default='', cast=Csv()))
+
+
+async def _sweep_tasks_periodically():
+    while True:
+        try:
+            deleted = task_store.delete_expired_tasks(time.time() - task_store.TASK_TTL)
+            if deleted:
+                print(f"Deleted {deleted} expired tasks")
+        except Exception as e:
+            print(f"Could not delete expired tasks: {e}")
+        await asyncio.sleep(TASK_SWEEP_INTERVAL)
 
 
 async def lifespan(app: FastAPI):
+    # running asyncio tasks of this worker; results live in the shared task store
     app.state.tasks = {}
+    task_store.init_store()
+    start_pool()
+    # outbound connection pools, shared by all requests of this worker
+    app.state.http = http_pool.open_client()
+    get_client()
+    await webhooks.start(app.state.http, get_webhook_secret)
+    uploads.init_uploads()
+    # deletes expired uploads and tasks periodically
+    uploads.start_sweeper()
+    task_sweeper = asyncio.create_task(_sweep_tasks_periodically())
     yield
+    task_sweeper.cancel()
+    await asyncio.gather(task_sweeper, return_exceptions=True)
+    await uploads.stop_sweeper()
+    await webhooks.stop()
+    await app.state.http.aclose()
+    await close_client()
+    shutdown_pool()
 
 
 # Initialize Firebase Admin SDK
@@ -45,7 +89,7 @@ if not firebase_admin._apps:
     firebase_admin.initialize_app(cred)
 
 db = firestore.client()
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=fast_json.JSONResponse)
 
 
 # Configure CORS
@@ -63,12 +107,15 @@ app.add_middleware(
     allow_headers=["*"], # Allows all headers
 )
 
-@app.post("/regenerate-client-secret")
-async def regenerate_client_secret(request: Request):
-    uid = request.headers.get("X-User-UID")
-    if not uid:
-        raise HTTPException(status_code=400, detail="Missing user UID")
+async def rotate_client_secret(uid: str) -> dict:
+    """
+    Generates a new client secret for the user and stores its hash, along with a
+    new webhook secret used to sign the user's callbacks (kept as is, since the
+    server needs it to sign).
 
+    Returns:
+        dict: the client id and the new secrets, which are only shown once
+    """
     client_ref = db.collection("users").document(uid)
     user_doc = client_ref.get()
 
@@ -81,20 +128,37 @@ async def regenerate_client_secret(request: Request):
 
     # Generate new secret
     client_secret = str(uuid.uuid4())
-    hashed_secret = bcrypt.hashpw(client_secret.encode(), bcrypt.gensalt()).decode()
+    hashed_secret = await run_cpu(hash_secret, client_secret)
+    webhook_secret = secrets.token_hex(32)
 
-    # Update only the secret
+    # Update only the secrets
     client_ref.update({
         "clientSecret": hashed_secret,
+        "webhookSecret": webhook_secret,
         "updatedAt": firestore.SERVER_TIMESTAMP,
     })
 
     return {
         "client_id": client_id,
-        "client_secret": client_secret  # Only shown once
+        "client_secret": client_secret,  # Only shown once
+        "webhook_secret": webhook_secret  # Only shown once
     }
 
 
+def get_webhook_secret(owner: str) -> str | None:
+    """
+    Returns:
+        str: the webhook secret of a task owner (user id or client id), None if it has none
+    """
+    user_doc = db.collection("users").document(owner).get()
+    if not user_doc.exists:
+        results = db.collection("users").where(filter=FieldFilter("clientId", "==", owner)).limit(1).get()
+        if not results:
+            return None
+        user_doc = results[0]
+    return user_doc.to_dict().get("webhookSecret")
+
+
 @app.post("/register-client")
 async def register_client(request: Request):
     auth_header = request.headers.get("Authorization")
@@ -120,17 +184,7 @@ async def register_client(request: Request):
             "createdAt": firestore.SERVER_TIMESTAMP,
         }, merge=True)
 
-    # Call regenerate-secret internally
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"{SERVER_URL}/regenerate-client-secret",
-            headers={"X-User-UID": uid}
-        )
-
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Failed to generate client secret")
-
-    return response.json()
+    return await rotate_client_secret(uid)
 
 
 def get_current_user(request: Request) -> dict:
@@ -145,11 +199,22 @@ def get_current_user(request: Request) -> dict:
     id_token = auth_header.split("Bearer ")[1]
     try:
         decoded_token = firebase_auth.verify_id_token(id_token)
-        return {"type": "user", "details": None}
+        return {"type": "user", "details": {"uid": decoded_token["uid"]}}
     except Exception:
         raise HTTPException(status_code=401, detail="Invalid Firebase token")
 
 
+def get_current_admin(user=Depends(get_current_user)) -> dict:
+    if user["details"]["uid"] not in ADMIN_UIDS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user
+
+
+@app.post("/regenerate-client-secret")
+async def regenerate_client_secret(user=Depends(get_current_user)):
+    return await rotate_client_secret(user["details"]["uid"])
+
+
 def get_current_entity(request: Request) -> dict:
     """Authenticate either a Firebase user or a backend client."""
     auth_header = request.headers.get("Authorization")
@@ -162,7 +227,7 @@ def get_current_entity(request: Request) -> dict:
         id_token = auth_header.split("Bearer ")[1]
         try:
             decoded_token = firebase_auth.verify_id_token(id_token)
-            return {"type": "user", "details": None}
+            return {"type": "user", "details": {"uid": decoded_token["uid"]}}
         except Exception:
             raise HTTPException(status_code=401, detail="Invalid Firebase token")
 
@@ -189,10 +254,10 @@ def get_current_entity(request: Request) -> dict:
             user_data = doc.to_dict()
             expected_secret = user_data.get("clientSecret")
 
-            if not expected_secret or not bcrypt.checkpw(client_secret.encode(), expected_secret.encode()):
+            if not expected_secret or not run_cpu_sync(check_secret, client_secret, expected_secret):
                 raise HTTPException(status_code=401, detail="Invalid client credentials")
 
-            return {"type": "client", "details": {"client_id": client_id}}
+            return {"type": "client", "details": {"client_id": client_id, "plan": user_data.get("plan")}}
 
         except Exception as e:
             print(e)
@@ -203,57 +268,178 @@ def get_current_entity(request: Request) -> dict:
 
 @app.get("/status/{task_id}")
 async def status(task_id:str, entity=Depends(get_current_entity)):
-    if task_id not in app.state.tasks.keys():
+    record = task_store.get_task(task_id)
+    if record is None:
         raise HTTPException(status_code=404, detail=f"Task id {task_id} was not found.") 
 
-    return app.state.tasks[task_id].is_done()
+    return record["status"] != task_store.PENDING
 
 
 @app.get("/result/{task_id}")
 async def result(task_id:str, entity=Depends(get_current_entity)):
-    if task_id not in app.state.tasks.keys():
+    # the stored JSON is sent as is, without decoding and encoding it again
+    record = task_store.get_task(task_id, decode=False)
+    if record is None:
         raise HTTPException(status_code=404, detail=f"Task id {task_id} was not found.") 
 
-    return app.state.tasks[task_id].result()
+    if record["status"] == task_store.PENDING:
+        raise HTTPException(status_code=409, detail=f"Task id {task_id} is not finished yet.")
 
+    if record["status"] == task_store.FAILED:
+        raise HTTPException(status_code=record["error_code"], detail=record["error"])
 
-def count_pdf_pages(pdf_path):
-    """
-    Counts the number of pages in a PDF file.
+    return Response(content=record["result"], media_type="application/json")
 
-    Args:
-        pdf_path (str): The path to the PDF file.
 
-    Returns:
-        int: The number of pages in the PDF, or -1 if an error occurs.
+@app.post("/export")
+async def export_results(
+    task_ids: List[str] | None = Body(None), # Tasks to export; if not given, the time range is used
+    since: datetime | None = Body(None), # Tasks created at or after this time
+    until: datetime | None = Body(None), # Tasks created before this time
+    format: Literal["ndjson", "csv"] = Body("ndjson"),
+    template_id: str | None = Body(None), # Template giving the CSV columns (default: the first result's)
+    entity=Depends(get_current_entity)
+):
+    """
+    Streams the results of finished async tasks of the caller, as NDJSON (one task per line)
+    or flattened into CSV columns derived from the template (nested fields become dotted columns).
     """
+    records = task_store.iter_finished_tasks(
+        _entity_owner(entity),
+        task_ids=list(dict.fromkeys(task_ids)) if task_ids is not None else None,
+        since=since.timestamp() if since is not None else None,
+        until=until.timestamp() if until is not None else None,
+    )
+
+    if format == "ndjson":
+        return StreamingResponse(export.ndjson_lines(records), media_type="application/x-ndjson")
+
+    template = get_template(template_id).schema if template_id is not None else None
+
+    return StreamingResponse(
+        export.csv_lines(records, template),
+        media_type="text/csv",
+        headers={"Content-Disposition": 'attachment; filename="export.csv"'}
+    )
+
+
+@app.get("/webhook-stats")
+async def webhook_stats(entity=Depends(get_current_entity)):
+    return task_store.get_delivery_stats(_entity_owner(entity))
+
+
+@app.get("/model-stats")
+async def model_stats(user=Depends(get_current_admin)):
+    return {
+        "models": routing.get_stats(),
+        "hedging": hedging.get_stats(),
+        "memory": admission.get_stats(),
+    }
+
+
+def _entity_plan(entity: dict) -> str | None:
+    # the plan is only known for API clients, whose user document is read during authentication
+    return entity["details"].get("plan")
+
+
+def _entity_owner(entity: dict) -> str:
+    details = entity["details"]
+    return details["client_id"] if entity["type"] == "client" else details["uid"]
+
+
+async def _check_callback_url(callback_url: str | None, entity: dict):
+    if callback_url is None:
+        return
+
+    refused = await webhooks.check_callback_url(callback_url)
+    if refused is not None:
+        raise HTTPException(status_code=400, detail=f"Invalid callback_url. {refused}")
+
+    # callbacks are signed with the owner's own key, which clients verify
+    if not await asyncio.to_thread(get_webhook_secret, _entity_owner(entity)):
+        raise HTTPException(
+            status_code=400,
+            detail="No webhook secret. Regenerate your client secret to get one before using callback_url."
+        )
+
+
+async def _run_task(task_id: str, coro, callback_url: str | None = None, owner: str | None = None):
     try:
-        with open(pdf_path, 'rb') as f:
-            pdf_reader = PyPDF2.PdfReader(f)
-            return len(pdf_reader.pages)
-    except FileNotFoundError:
-        print(f"Error: File not found at {pdf_path}")
-        return -1
-    except PyPDF2.errors.PdfReadError:
-        print(f"Error: Could not read PDF file at {pdf_path}")
-        return -1
+        res = await coro
+        result_size = task_store.set_done(task_id, res)
+        admission.record_result_size(result_size)
+    except HTTPException as e:
+        task_store.set_failed(task_id, e.detail, e.status_code)
     except Exception as e:
-        print(f"An unexpected error occurred: {e}")
-        return -1
+        task_store.set_failed(task_id, f"An error occurred: {e}")
+
+    if callback_url is not None:
+        webhooks.enqueue(task_id, owner, callback_url)
+
+
+def _start_task(coro, callback_url: str | None = None, owner: str | None = None) -> str:
+    """
+    Schedules coro in the background and records it in the shared task store.
+    If callback_url is given, the outcome is POSTed there once the task completes.
+
+    Returns:
+        str: the task id to use with /status and /result
+    """
+    task_id = str(uuid.uuid4())
+    task_store.create_task(task_id, owner)
+    task = asyncio.create_task(_run_task(task_id, coro, callback_url, owner))
+    app.state.tasks[task_id] = task
+    task.add_done_callback(lambda _: app.state.tasks.pop(task_id, None))
+    return task_id
+
+
+def _check_pdf(filename: str):
+    allowed_extensions = ["pdf"]
+    file_extension = filename.split(".")[-1].lower()
+
+    if file_extension not in allowed_extensions:
+        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF is allowed.")
+
+
+def _resolve_document(file: UploadFile | None, upload_id: str | None, entity: dict) -> tuple[str, bool]:
+    """
+    Finds the document of an extraction request: either a file sent with the
+    request, which is streamed to a temporary file, or a finalized resumable upload.
+
+    Returns:
+        tuple: (path of the PDF on disk, whether it is a temporary file to delete after the extraction)
+    """
+    if upload_id is not None:
+        try:
+            path, filename = uploads.get_finalized_path(upload_id, _entity_owner(entity))
+        except uploads.UploadError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        _check_pdf(filename)
+        return str(path), False
+
+    if file is None:
+        raise HTTPException(status_code=400, detail="Provide either a file or an upload_id.")
+
+    _check_pdf(file.filename)
+    # unique name so concurrent uploads of files with the same name do not collide
+    file_location = f"temp_{uuid.uuid4().hex}_{Path(file.filename).name}"
+    with open(file_location, "wb") as file_object:
+        shutil.copyfileobj(file.file, file_object)
+    return file_location, True
 
 
 async def _do_extract(
-    file: UploadFile = File(...),
-    template: str|None = None
+    file_location: str,
+    template: Template|None = None,
+    plan: str|None = None,
+    cleanup: bool = True
 ):
     try:
-        file_location = f"temp_{file.filename}"
-        with open(file_location, "wb+") as file_object:
-            file_object.write(file.file.read())
+        # waits while the projected memory of the running jobs would exceed the budget
+        async with admission.reserve(os.path.getsize(file_location)):
+            nb_pages = await run_cpu(count_pdf_pages, file_location)
 
-        nb_pages = count_pdf_pages(file_location)
-
-        res = await ai_extract(file_location, template)
+            res = await ai_extract(file_location, template, nb_pages, plan)
         summary = res['summary']
         template = res['template']
 
@@ -265,50 +451,137 @@ async def _do_extract(
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred during file upload: {e}")
-    
+
+    finally:
+        if cleanup:
+            Path(file_location).unlink(missing_ok=True)
+
+
+async def _do_extract_many(
+    file_location: str,
+    templates: Dict[str, Template],
+    plan: str|None = None,
+    cleanup: bool = True
+):
+    try:
+        async with admission.reserve(os.path.getsize(file_location)):
+            nb_pages = await run_cpu(count_pdf_pages, file_location)
+
+            results = await ai_extract_many(file_location, templates, nb_pages, plan)
+
+        return {
+            'nb_pages': nb_pages,
+            'results': results
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred during file upload: {e}")
+
+    finally:
+        if cleanup:
+            Path(file_location).unlink(missing_ok=True)
+
+
+#--- Resumable uploads
+#
+# POST /uploads creates a session, PUT /uploads/{upload_id}?offset=n appends the request body,
+# GET /uploads/{upload_id} tells how many bytes were received, POST /uploads/{upload_id}/finalize completes it.
+# The upload_id can then be given to the extraction endpoints instead of a file.
+
+def _upload_response(upload: dict) -> dict:
+    return {
+        "upload_id": upload["upload_id"],
+        "filename": upload["filename"],
+        "size": upload["size"],
+        "received": upload["received"],
+        "status": upload["status"],
+        "sha256": upload["sha256"],
+    }
+
+
+@app.post("/uploads")
+async def create_upload(
+    filename: str = Body(...),
+    size: int | None = Body(None), # Total size in bytes, if known
+    entity=Depends(get_current_entity)
+):
+    _check_pdf(filename)
+    try:
+        upload = uploads.create_upload(_entity_owner(entity), filename, size)
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return _upload_response(upload)
+
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request, entity=Depends(get_current_entity)):
+    try:
+        upload = await uploads.write_chunk(upload_id, _entity_owner(entity), offset, request.stream())
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return _upload_response(upload)
+
+
+@app.get("/uploads/{upload_id}")
+async def upload_status(upload_id: str, entity=Depends(get_current_entity)):
+    try:
+        upload = uploads.get_upload(upload_id, _entity_owner(entity))
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return _upload_response(upload)
+
+
+@app.post("/uploads/{upload_id}/finalize")
+async def finalize_upload(upload_id: str, entity=Depends(get_current_entity)):
+    try:
+        upload = uploads.finalize_upload(upload_id, _entity_owner(entity))
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    return _upload_response(upload)
+
 
 #--- Explanations
 #
 # extract and async_extract will generate a tempalte and perform extraction using that template
 # extract_with_template and async_extract_with_template will take a template_id, fetch that template, and use it for extraction
+# extract_with_templates will take several template_ids and extract the same document with each of them
 
 @app.post("/extract")
 async def extract(
-    file: UploadFile = File(...),
+    file: UploadFile | None = File(None),
+    upload_id: str | None = Body(None), # Finalized resumable upload, instead of file
     entity=Depends(get_current_entity)
 ):
     """
     Receives a document (PDF or CSV) and processes it for AI summarization.
     Only accessible to authenticated users on the website.
     """
-    allowed_extensions = ["pdf"]
-    file_extension = file.filename.split(".")[-1].lower()
-
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF is allowed.")
+    file_location, cleanup = _resolve_document(file, upload_id, entity)
     
-    return await _do_extract(file)
+    # returned as a response directly, which skips FastAPI's encoding pass over the result
+    return fast_json.JSONResponse(await _do_extract(file_location, plan=_entity_plan(entity), cleanup=cleanup))
 
 
 @app.post("/async-extract")
 async def async_extract(
-    file: UploadFile = File(...),
+    file: UploadFile | None = File(None),
+    upload_id: str | None = Body(None), # Finalized resumable upload, instead of file
+    callback_url: str | None = Body(None), # Optional webhook called on completion
     entity=Depends(get_current_entity)
 ):
     """
     Receives a document (PDF or CSV) and processes it for AI summarization.
     Only accessible to authenticated users (website or API).
     """
-    allowed_extensions = ["pdf"]
-    file_extension = file.filename.split(".")[-1].lower()
-
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF is allowed.")
-
-    task = asyncio.create_task(_do_extract(file))
-    task_id = str(uuid.uuid4())
-    app.state.tasks[task_id] = task
-    return task_id
+    await _check_callback_url(callback_url, entity)
+    # saved before the task starts: the request's file is closed once the response is sent
+    file_location, cleanup = _resolve_document(file, upload_id, entity)
+
+    return _start_task(
+        _do_extract(file_location, plan=_entity_plan(entity), cleanup=cleanup),
+        callback_url,
+        _entity_owner(entity)
+    )
     
 
 def get_template(template_id: str):
@@ -319,57 +592,101 @@ def get_template(template_id: str):
         raise HTTPException(status_code=404, detail=f"Template with ID {template_id} not found.")
 
     template_data = template_doc.to_dict()
-    template = template_data.get("summary")
+    return _load_template(template_id, template_data.get("summary"))
+
 
-    if not template:
+def _load_template(template_id: str, summary) -> Template:
+    '''
+    Parses a saved template (stored as JSON text or as a map) once into its canonical form.
+    '''
+    if not summary:
         raise HTTPException(status_code=400, detail=f"Template with ID {template_id} has no summary data.")
-    
-    return template
+
+    try:
+        return Template.load(summary)
+    except ValueError as e:
+        # json.JSONDecodeError and orjson.JSONDecodeError are both ValueErrors
+        raise HTTPException(status_code=400, detail=f"Template with ID {template_id} is not a valid JSON object: {e}")
+
+
+def get_templates(template_ids: List[str]) -> Dict[str, Template]:
+    """
+    Fetches several templates in a single Firestore round-trip.
+
+    Returns:
+        dict: template id -> template, in the order of template_ids
+    """
+    refs = [db.collection("templates").document(template_id) for template_id in template_ids]
+    docs = {doc.id: doc for doc in db.get_all(refs)}
+
+    templates = {}
+    for template_id in template_ids:
+        doc = docs.get(template_id)
+        if doc is None or not doc.exists:
+            raise HTTPException(status_code=404, detail=f"Template with ID {template_id} not found.")
+
+        templates[template_id] = _load_template(template_id, doc.to_dict().get("summary"))
+
+    return templates
 
 
 @app.post("/extract-with-template")
 async def extract_with_template(
-    file: UploadFile = File(...),
+    file: UploadFile | None = File(None),
     template_id: str = Body(...), # Accept template ID
+    upload_id: str | None = Body(None), # Finalized resumable upload, instead of file
     user=Depends(get_current_entity)
 ):
     """
     Receives a document (PDF or CSV) and processes it for AI summarization using a template.
     Only accessible to authenticated users on the website.
     """
-    allowed_extensions = ["pdf"]
-    file_extension = file.filename.split(".")[-1].lower()
-
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF is allowed.")
-    
     template = get_template(template_id)
+    file_location, cleanup = _resolve_document(file, upload_id, user)
     
-    return await _do_extract(file, template)
+    return fast_json.JSONResponse(await _do_extract(file_location, template, _entity_plan(user), cleanup))
+
+
+@app.post("/extract-with-templates")
+async def extract_with_templates(
+    file: UploadFile | None = File(None),
+    template_ids: List[str] = Form(...), # Accept several template IDs (repeat the field)
+    upload_id: str | None = Form(None), # Finalized resumable upload, instead of file
+    entity=Depends(get_current_entity)
+):
+    """
+    Receives a document (PDF) and extracts it with each of the given templates.
+    The document is uploaded to the model once and the extractions run concurrently.
+    Results are keyed by template ID.
+    """
+    # dict.fromkeys drops duplicates while keeping the order
+    templates = get_templates(list(dict.fromkeys(template_ids)))
+    file_location, cleanup = _resolve_document(file, upload_id, entity)
+
+    return fast_json.JSONResponse(await _do_extract_many(file_location, templates, _entity_plan(entity), cleanup))
 
 
 @app.post("/async-extract-with-template")
 async def async_extract_with_template(
-    file: UploadFile = File(...),
+    file: UploadFile | None = File(None),
     template_id: str = Body(...), # Accept template ID
+    upload_id: str | None = Body(None), # Finalized resumable upload, instead of file
+    callback_url: str | None = Body(None), # Optional webhook called on completion
     entity=Depends(get_current_entity)
 ):
     """
     Receives a document (PDF or CSV) and processes it for AI summarization using a template.
     Only accessible to authenticated users (website or API).
     """
-    allowed_extensions = ["pdf"]
-    file_extension = file.filename.split(".")[-1].lower()
-
-    if file_extension not in allowed_extensions:
-        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF is allowed.")
-    
+    await _check_callback_url(callback_url, entity)
     template = get_template(template_id)
+    file_location, cleanup = _resolve_document(file, upload_id, entity)
     
-    task = asyncio.create_task(_do_extract(file, template))
-    task_id = str(uuid.uuid4())
-    app.state.tasks[task_id] = task
-    return task_id
+    return _start_task(
+        _do_extract(file_location, template, _entity_plan(entity), cleanup),
+        callback_url,
+        _entity_owner(entity)
+    )
 
         
 @app.post("/extract-many-with-template/")
@@ -444,7 +761,7 @@ async def read_root():
 
 def main():
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=False)
+    uvicorn.run("app:app", host="0.0.0.0", port=port, reload=False, workers=WEB_CONCURRENCY)
 
 if __name__ == '__main__':
     main()
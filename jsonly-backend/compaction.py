@@ -0,0 +1,206 @@
+from decouple import config
+import copy
+import json
+
+
+# Opt-in: compact templates before they are turned into the response schema
+SCHEMA_COMPACTION = config('SCHEMA_COMPACTION', default=False, cast=bool)
+# Descriptions are cut to this many characters (0 removes them)
+SCHEMA_MAX_DESCRIPTION_CHARS = config('SCHEMA_MAX_DESCRIPTION_CHARS', default=80, cast=int)
+# Subschemas repeated at least twice and larger than this (as JSON) move to shared definitions
+SCHEMA_MIN_SHARED_CHARS = config('SCHEMA_MIN_SHARED_CHARS', default=200, cast=int)
+
+# Separator of the keys of flattened objects, e.g. {"a": {"b": ...}} -> {"a__b": ...}
+FLAT_SEPARATOR = "__"
+
+# Keywords an object may carry and still be flattened into its parent
+_FLATTENABLE_KEYS = {"type", "properties", "required", "description", "title", "additionalProperties"}
+
+
+def estimate_tokens(schema) -> int:
+    '''
+    Rough token count of a schema (about 4 characters per token of minified JSON).
+    '''
+    return len(json.dumps(schema, separators=(",", ":"))) // 4
+
+
+def _truncate(description: str) -> str | None:
+    if SCHEMA_MAX_DESCRIPTION_CHARS <= 0:
+        return None
+    if len(description) <= SCHEMA_MAX_DESCRIPTION_CHARS:
+        return description
+    cut = description[:SCHEMA_MAX_DESCRIPTION_CHARS].rsplit(" ", 1)[0]
+    return cut.rstrip(",.;:") + "..."
+
+
+def _compact_descriptions(schema):
+    if isinstance(schema, list):
+        return [_compact_descriptions(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+
+    compacted = {}
+    for key, value in schema.items():
+        if key == "description" and isinstance(value, str):
+            value = _truncate(value)
+            if value is None:
+                continue
+        elif key == "properties" and isinstance(value, dict):
+            # property names are not keywords, only their schemas are compacted
+            value = {name: _compact_descriptions(sub) for name, sub in value.items()}
+        elif key not in ("enum", "const", "default", "examples", "required"):
+            value = _compact_descriptions(value)
+        compacted[key] = value
+    return compacted
+
+
+def _single_property(schema) -> str | None:
+    '''
+    Returns: the name of the only property of a plain object schema, or None
+    '''
+    if not isinstance(schema, dict) or schema.get("type") != "object":
+        return None
+    if not set(schema) <= _FLATTENABLE_KEYS:
+        return None
+    properties = schema.get("properties")
+    if not isinstance(properties, dict) or len(properties) != 1:
+        return None
+    return next(iter(properties))
+
+
+def _flatten(schema) -> tuple[dict, dict | None]:
+    '''
+    Returns: (the schema with single-property objects merged into their parent,
+        the shape used by restore to rebuild values of the original schema)
+    '''
+    if not isinstance(schema, dict):
+        return schema, None
+
+    if isinstance(schema.get("items"), dict):
+        items, items_shape = _flatten(schema["items"])
+        return {**schema, "items": items}, ({"items": items_shape} if items_shape else None)
+
+    properties = schema.get("properties")
+    if not isinstance(properties, dict):
+        return schema, None
+
+    new_properties = {}
+    new_required = []
+    props_shape = {}
+    required = set(schema.get("required", []))
+    for name, sub in properties.items():
+        path = [name]
+        is_required = name in required
+        # walk down chains of single-property objects
+        while (child := _single_property(sub)) is not None:
+            is_required = is_required and child in sub.get("required", [])
+            path.append(child)
+            sub = sub["properties"][child]
+
+        sub, sub_shape = _flatten(sub)
+        key = FLAT_SEPARATOR.join(path)
+        if len(path) > 1 and (key in properties or key in new_properties):
+            # would collide with an existing property: keep it nested
+            key, path, sub, sub_shape = name, [name], *_flatten(properties[name])
+            is_required = name in required
+
+        new_properties[key] = sub
+        if is_required:
+            new_required.append(key)
+        if len(path) > 1 or sub_shape:
+            props_shape[key] = (path, sub_shape)
+
+    compacted = {**schema, "properties": new_properties}
+    if "required" in schema or new_required:
+        compacted["required"] = new_required
+    return compacted, ({"properties": props_shape} if props_shape else None)
+
+
+def _share_repeated(schema: dict) -> dict:
+    '''
+    Moves object subschemas that appear several times into "$defs" and
+    replaces them with references.
+    '''
+    counts = {}
+    # first occurrence of each subschema, whose key order is kept in the shared definition
+    originals = {}
+
+    def count(node):
+        if isinstance(node, dict):
+            if node.get("type") == "object":
+                # sorted keys, so that the same subschema written in another order is shared too
+                key = json.dumps(node, sort_keys=True)
+                if len(key) >= SCHEMA_MIN_SHARED_CHARS:
+                    counts[key] = counts.get(key, 0) + 1
+                    originals.setdefault(key, node)
+            for value in node.values():
+                count(value)
+        elif isinstance(node, list):
+            for value in node:
+                count(value)
+
+    count(schema.get("properties", {}))
+    repeated = [key for key, nb in counts.items() if nb > 1]
+    if not repeated:
+        return schema
+
+    defs = dict(schema.get("$defs", {}))
+    names = {}
+    for i, key in enumerate(repeated, start=1):
+        name = f"Shared{i}"
+        while name in defs:
+            name += "_"
+        names[key] = name
+        defs[name] = originals[key]
+
+    def replace(node, top=False):
+        if isinstance(node, dict):
+            key = json.dumps(node, sort_keys=True)
+            if not top and key in names:
+                return {"$ref": f"#/$defs/{names[key]}"}
+            return {k: replace(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [replace(v) for v in node]
+        return node
+
+    # the shared definitions themselves are kept whole
+    return {**replace(schema, top=True), "$defs": defs}
+
+
+def compact_schema(schema: dict) -> tuple[dict, dict | None]:
+    '''
+    Args:
+        schema: the template, as a JSON schema
+    Returns: (the compacted schema, the shape to give to restore)
+    '''
+    schema = _compact_descriptions(copy.deepcopy(schema))
+    schema, shape = _flatten(schema)
+    return _share_repeated(schema), shape
+
+
+def restore(value, shape: dict | None):
+    '''
+    Rebuilds a value extracted with a compacted schema into the shape of the original schema.
+    '''
+    if shape is None:
+        return value
+
+    if "items" in shape:
+        if not isinstance(value, list):
+            return value
+        return [restore(item, shape["items"]) for item in value]
+
+    if not isinstance(value, dict):
+        return value
+
+    restored = {}
+    for key, sub in value.items():
+        if key not in shape["properties"]:
+            restored[key] = sub
+            continue
+        path, sub_shape = shape["properties"][key]
+        target = restored
+        for name in path[:-1]:
+            target = target.setdefault(name, {})
+        target[path[-1]] = restore(sub, sub_shape)
+    return restored
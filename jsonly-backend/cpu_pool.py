@@ -0,0 +1,151 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import multiprocessing
+import asyncio
+import os
+import time
+import bcrypt
+import PyPDF2
+from decouple import config
+
+
+# Number of uvicorn worker processes (uvicorn also reads this variable natively)
+WEB_CONCURRENCY = config('WEB_CONCURRENCY', default=1, cast=int)
+
+# Size of the per-process pool used for CPU-bound work. Defaults to sharing the
+# machine's cores between the uvicorn workers.
+CPU_WORKERS = config(
+    'CPU_WORKERS',
+    default=max(1, (os.cpu_count() or 1) // max(1, WEB_CONCURRENCY)),
+    cast=int
+)
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def _warm_up():
+    '''
+    Runs once in every pool process so the first real job does not pay for
+    the codegen and pydantic imports.
+    '''
+    import datamodel_code_generator  # noqa: F401
+    import pydantic  # noqa: F401
+
+
+def _ready() -> int:
+    # held briefly so that each of the warm-up jobs lands in a different process
+    time.sleep(0.1)
+    return os.getpid()
+
+
+def start_pool() -> ProcessPoolExecutor:
+    '''
+    Creates the pool and waits until its processes are started and warmed up,
+    so the first requests do not pay for spawning them.
+    '''
+    global _pool
+    if _pool is None:
+        # spawn: forking a process that already runs grpc/firebase threads is unsafe
+        _pool = ProcessPoolExecutor(
+            max_workers=CPU_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_warm_up,
+        )
+        # processes are only started when jobs are submitted, and run
+        # _warm_up before their first job
+        pids = set()
+        for _ in range(3):
+            futures = [_pool.submit(_ready) for _ in range(CPU_WORKERS)]
+            pids.update(future.result() for future in futures)
+            if len(pids) >= CPU_WORKERS:
+                break
+    return _pool
+
+
+def worker_pids() -> list[int]:
+    '''
+    Returns: the process ids of the pool processes currently running
+    '''
+    if _pool is None:
+        return []
+    # _processes is only filled once the processes are started
+    return list(getattr(_pool, "_processes", None) or {})
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+async def run_cpu(fn, *args, **kwargs):
+    '''
+    Runs fn in the process pool without blocking the event loop.
+    fn and its arguments must be picklable (module-level functions only).
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(start_pool(), partial(fn, *args, **kwargs))
+
+
+def run_cpu_sync(fn, *args, **kwargs):
+    '''
+    Same as run_cpu, for sync code already running in a threadpool (e.g. sync dependencies).
+    '''
+    return start_pool().submit(fn, *args, **kwargs).result()
+
+
+#--- CPU-bound jobs (executed in the pool processes)
+
+def hash_secret(secret: str) -> str:
+    return bcrypt.hashpw(secret.encode(), bcrypt.gensalt()).decode()
+
+
+def check_secret(secret: str, hashed: str) -> bool:
+    return bcrypt.checkpw(secret.encode(), hashed.encode())
+
+
+def count_pdf_pages(pdf_path):
+    """
+    Counts the number of pages in a PDF file.
+
+    Args:
+        pdf_path (str): The path to the PDF file.
+
+    Returns:
+        int: The number of pages in the PDF, or -1 if an error occurs.
+    """
+    try:
+        with open(pdf_path, 'rb') as f:
+            pdf_reader = PyPDF2.PdfReader(f)
+            return len(pdf_reader.pages)
+    except FileNotFoundError:
+        print(f"Error: File not found at {pdf_path}")
+        return -1
+    except PyPDF2.errors.PdfReadError:
+        print(f"Error: Could not read PDF file at {pdf_path}")
+        return -1
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+        return -1
+
+
+def generate_model_source(template: str) -> str:
+    '''
+    Args:
+        template: JSON schema as a string
+    Returns: the source code of the pydantic module generated for the schema
+    '''
+    from datamodel_code_generator import InputFileType, generate, DataModelType
+
+    with TemporaryDirectory() as tmp_dir:
+        output = Path(tmp_dir) / 'model.py'
+        generate(
+            template,
+            input_file_type=InputFileType.JsonSchema,
+            output=output,
+            output_model_type=DataModelType.PydanticV2BaseModel,
+        )
+        return output.read_text()
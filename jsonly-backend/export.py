@@ -0,0 +1,126 @@
+import csv
+import io
+import json
+import fast_json
+
+
+# Columns present in every CSV export, before the template's columns
+BASE_COLUMNS = ["task_id", "task_status", "task_created_at", "task_error", "nb_pages"]
+
+
+def _column_type(sub) -> str | None:
+    '''
+    Returns: the JSON schema type of a property; for a list of types
+    (e.g. ["string", "null"]), the first one that is not "null"
+    '''
+    kind = sub.get("type") if isinstance(sub, dict) else None
+    if isinstance(kind, list):
+        kind = next((k for k in kind if k != "null"), None)
+    return kind if isinstance(kind, str) else None
+
+
+def schema_columns(schema: dict, prefix: str = "", defs: dict | None = None, depth: int = 0) -> list[tuple[str, str | None]]:
+    '''
+    Derives flat columns from a template: nested objects become dotted
+    columns (e.g. newCharges.internet), arrays stay a single JSON column.
+
+    Returns: list of (column name, JSON schema type or None)
+    '''
+    if defs is None:
+        defs = {**schema.get("definitions", {}), **schema.get("$defs", {})}
+
+    columns = []
+    for name, sub in schema.get("properties", {}).items():
+        column = f"{prefix}{name}"
+        if isinstance(sub, dict) and "$ref" in sub:
+            sub = defs.get(sub["$ref"].split("/")[-1], {})
+        if isinstance(sub, dict) and isinstance(sub.get("properties"), dict) and depth < 10:
+            columns.extend(schema_columns(sub, f"{column}.", defs, depth + 1))
+        else:
+            columns.append((column, _column_type(sub)))
+    return columns
+
+
+def _get_path(value, path: str):
+    for name in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def flatten_row(record: dict, columns: list[str]) -> list:
+    result = record["result"] or {}
+    row = [record["task_id"], record["status"], record["created_at"], record["error"], result.get("nb_pages")]
+    for column in columns:
+        value = _get_path(result.get("summary"), column)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        row.append(value)
+    return row
+
+
+def _template_of(record: dict) -> dict | None:
+    result = record["result"]
+    if isinstance(result, dict) and isinstance(result.get("template"), dict):
+        return result["template"]
+    return None
+
+
+def _with_columns(records, template: dict | None):
+    '''
+    Returns: (template columns, records) where the columns come from template or,
+    if None, from the first record that has one (the records are not consumed).
+    '''
+    records = iter(records)
+    peeked = []
+    while template is None:
+        record = next(records, None)
+        if record is None:
+            break
+        peeked.append(record)
+        template = _template_of(record)
+
+    columns = schema_columns(template) if template is not None else []
+    columns = [(name, kind) for name, kind in columns if name not in BASE_COLUMNS]
+
+    def chained():
+        yield from peeked
+        yield from records
+
+    return columns, chained()
+
+
+def ndjson_lines(records):
+    for record in records:
+        line = {
+            "task_id": record["task_id"],
+            "status": record["status"],
+            "created_at": record["created_at"],
+        }
+        if record["error"] is not None:
+            line["error"] = record["error"]
+        else:
+            line["result"] = record["result"]
+        yield fast_json.dumps(line) + "\n"
+
+
+def csv_lines(records, template: dict | None = None):
+    columns, records = _with_columns(records, template)
+    names = [name for name, _ in columns]
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(BASE_COLUMNS + names)
+    yield flush()
+    for record in records:
+        writer.writerow(flatten_row(record, names))
+        yield flush()
+
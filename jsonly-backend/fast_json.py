@@ -0,0 +1,32 @@
+from fastapi.responses import JSONResponse as _JSONResponse
+import json
+
+try:
+    # a dependency of the project; the standard json module is a fallback for other environments
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value, sort_keys: bool = False) -> str:
+    '''
+    Returns: value as compact JSON
+    '''
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(value, sort_keys=sort_keys, ensure_ascii=False, separators=(",", ":"))
+
+
+def loads(text: str | bytes):
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class JSONResponse(_JSONResponse):
+    '''
+    JSON response rendered with orjson when it is installed. Returning it directly from
+    an endpoint also skips FastAPI's jsonable_encoder pass over large nested results.
+    '''
+    def render(self, content) -> bytes:
+        return dumps(content).encode()
@@ -0,0 +1,94 @@
+from collections import deque
+from decouple import config
+import asyncio
+import logging
+import statistics
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Opt-in: a call still running after the HEDGE_PERCENTILE of recent latencies
+# gets a duplicate request, and the first answer wins
+HEDGING = config('GEMINI_HEDGING', default=False, cast=bool)
+HEDGE_PERCENTILE = config('HEDGE_PERCENTILE', default=95, cast=int)
+if not 1 <= HEDGE_PERCENTILE <= 99:
+    # statistics.quantiles(n=100) only has the 1st to 99th percentiles
+    raise ValueError(f"HEDGE_PERCENTILE must be between 1 and 99, got {HEDGE_PERCENTILE}.")
+# maximum share of extra calls, e.g. 0.05 = at most 5% more calls
+HEDGE_BUDGET = config('HEDGE_BUDGET', default=0.05, cast=float)
+HEDGE_MIN_SAMPLES = config('HEDGE_MIN_SAMPLES', default=20, cast=int)
+HEDGE_WINDOW = config('HEDGE_WINDOW', default=200, cast=int)
+
+# model name -> latencies of recent successful calls
+_latencies: dict[str, deque] = {}
+_stats = {"calls": 0, "hedges_issued": 0, "hedges_won": 0}
+
+
+def _hedge_delay(model: str) -> float | None:
+    latencies = _latencies.get(model, ())
+    if not HEDGING or len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return statistics.quantiles(latencies, n=100)[HEDGE_PERCENTILE - 1]
+
+
+def _record_latency(model: str, latency: float):
+    _latencies.setdefault(model, deque(maxlen=HEDGE_WINDOW)).append(latency)
+
+
+async def _timed(coro):
+    start = time.monotonic()
+    res = await coro
+    return res, time.monotonic() - start
+
+
+async def generate_content(client, *, model: str, contents: list, config=None):
+    '''
+    Same as client.aio.models.generate_content, hedged when enabled.
+    '''
+    def call():
+        return _timed(client.aio.models.generate_content(model=model, contents=contents, config=config))
+
+    _stats["calls"] += 1
+    delay = _hedge_delay(model)
+    if delay is None:
+        res, latency = await call()
+        _record_latency(model, latency)
+        return res
+
+    primary = asyncio.create_task(call())
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done and _stats["hedges_issued"] < HEDGE_BUDGET * _stats["calls"]:
+            _stats["hedges_issued"] += 1
+            logger.info(f"{model} call still running after {delay:.1f}s; sending a hedged request")
+            pending.add(asyncio.create_task(call()))
+        pending |= done
+
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    # keep the first error, and wait for the other request if any
+                    error = error or task.exception()
+                    continue
+                res, latency = task.result()
+                _record_latency(model, latency)
+                if task is not primary:
+                    _stats["hedges_won"] += 1
+                return res
+
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def get_stats() -> dict:
+    return {
+        "enabled": HEDGING,
+        **_stats,
+        "hedge_delays": {model: _hedge_delay(model) for model in _latencies},
+    }
@@ -0,0 +1,32 @@
+import importlib.util
+import httpx
+from decouple import config
+
+
+# HTTP/2 needs the h2 package (httpx[http2], a dependency of the project); HTTP/1.1 is used without it
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+OUTBOUND_MAX_CONNECTIONS = config('OUTBOUND_MAX_CONNECTIONS', default=50, cast=int)
+OUTBOUND_MAX_KEEPALIVE = config('OUTBOUND_MAX_KEEPALIVE', default=20, cast=int)
+OUTBOUND_KEEPALIVE_EXPIRY = config('OUTBOUND_KEEPALIVE_EXPIRY', default=60.0, cast=float)
+
+
+def client_args() -> dict:
+    '''
+    Returns: the httpx.AsyncClient arguments shared by every outbound connection pool
+    '''
+    return {
+        "http2": HTTP2,
+        "limits": httpx.Limits(
+            max_connections=OUTBOUND_MAX_CONNECTIONS,
+            max_keepalive_connections=OUTBOUND_MAX_KEEPALIVE,
+            keepalive_expiry=OUTBOUND_KEEPALIVE_EXPIRY,
+        ),
+    }
+
+
+def open_client(**kwargs) -> httpx.AsyncClient:
+    '''
+    Creates a pooled client; meant to be created once in the app's lifespan and closed on shutdown.
+    '''
+    return httpx.AsyncClient(**client_args(), **kwargs)
@@ -0,0 +1,96 @@
+from io import BytesIO
+from pathlib import Path
+from decouple import config, Csv
+import hashlib
+import re
+import sys
+import PyPDF2
+
+
+# Pre-processing is opt-in: the model sees the text layer instead of the rendered pages
+PDF_PREPROCESS = config('PDF_PREPROCESS', default=False, cast=bool)
+
+# Fingerprints (see page_fingerprint) of pages to drop, e.g. marketing pages
+# that every bill of a given provider carries. Run `python preprocess.py file.pdf`
+# to print the fingerprints of each page of a sample document.
+PDF_BOILERPLATE_FINGERPRINTS = set(config('PDF_BOILERPLATE_FINGERPRINTS', default='', cast=Csv()))
+
+# Below this average number of characters per page, the PDF is considered
+# scanned and is still sent as a binary
+PDF_MIN_CHARS_PER_PAGE = config('PDF_MIN_CHARS_PER_PAGE', default=200, cast=int)
+
+
+def page_fingerprint(text: str) -> str | None:
+    '''
+    Fingerprint of a page's text that ignores case, digits and whitespace so that
+    the same boilerplate page matches across bills (dates, amounts and account
+    numbers differ). Returns None for pages without meaningful text.
+    '''
+    normalized = re.sub(r"[\d\s]+", " ", text.lower()).strip()
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode()).hexdigest()[:16]
+
+
+def preprocess_pdf(filepath: str) -> dict:
+    '''
+    Runs in the CPU pool.
+
+    Returns: a dict with
+        - text: the text layer with page markers, or None if the PDF is scanned
+        - pdf: the PDF bytes without the boilerplate pages, or the original bytes
+            if re-writing them does not make the file smaller (only when text is None)
+        - nb_pages: number of pages in the original document
+        - dropped_pages: 1-based numbers of the pages that were dropped
+    '''
+    reader = PyPDF2.PdfReader(filepath)
+
+    kept = []
+    dropped_pages = []
+    for number, page in enumerate(reader.pages, start=1):
+        text = page.extract_text() or ""
+        if page_fingerprint(text) in PDF_BOILERPLATE_FINGERPRINTS:
+            dropped_pages.append(number)
+            continue
+        kept.append((number, page, text))
+
+    total_chars = sum(len(text.strip()) for _, _, text in kept)
+    if kept and total_chars / len(kept) >= PDF_MIN_CHARS_PER_PAGE:
+        text = "\n\n".join(
+            f"--- Page {number} of {len(reader.pages)} ---\n{text.strip()}"
+            for number, _, text in kept
+        )
+        return {
+            'text': text,
+            'pdf': None,
+            'nb_pages': len(reader.pages),
+            'dropped_pages': dropped_pages,
+        }
+
+    # PyPDF2 cannot re-encode images; dropping pages and compressing the
+    # content streams is what can be done for scanned documents.
+    writer = PyPDF2.PdfWriter()
+    for _, page, _ in kept:
+        page.compress_content_streams()
+        writer.add_page(page)
+    buffer = BytesIO()
+    writer.write(buffer)
+    pdf = buffer.getvalue()
+
+    original = Path(filepath).read_bytes()
+    if len(pdf) >= len(original):
+        # a re-written PDF can be larger, e.g. when the original used object streams
+        pdf = original
+        dropped_pages = []
+
+    return {
+        'text': None,
+        'pdf': pdf,
+        'nb_pages': len(reader.pages),
+        'dropped_pages': dropped_pages,
+    }
+
+
+if __name__ == '__main__':
+    for number, page in enumerate(PyPDF2.PdfReader(sys.argv[1]).pages, start=1):
+        print(f"page {number}: {page_fingerprint(page.extract_text() or '')}")
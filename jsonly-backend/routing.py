@@ -0,0 +1,121 @@
+from collections import deque
+from decouple import config, Csv
+import random
+import statistics
+
+
+LITE_MODEL = config('ROUTING_LITE_MODEL', default='gemini-2.0-flash-lite')
+STANDARD_MODEL = config('ROUTING_STANDARD_MODEL', default='gemini-2.0-flash')
+LARGE_MODEL = config('ROUTING_LARGE_MODEL', default='gemini-2.5-flash')
+# used when the chosen model is overloaded (503) or failing
+FALLBACK_MODEL = config('ROUTING_FALLBACK_MODEL', default='gemini-2.0-flash-lite')
+
+# Short single-page bills with small templates go to the lite model
+LITE_MAX_PAGES = config('ROUTING_LITE_MAX_PAGES', default=1, cast=int)
+LITE_MAX_TEMPLATE_CHARS = config('ROUTING_LITE_MAX_TEMPLATE_CHARS', default=2000, cast=int)
+# Long statements or big templates go to the large model, for plans that include it
+LARGE_MIN_PAGES = config('ROUTING_LARGE_MIN_PAGES', default=10, cast=int)
+LARGE_MIN_TEMPLATE_CHARS = config('ROUTING_LARGE_MIN_TEMPLATE_CHARS', default=20000, cast=int)
+LARGE_PLANS = set(config('ROUTING_LARGE_PLANS', default='Pro,Business', cast=Csv()))
+
+# Feedback from recent calls
+LATENCY_SLO = config('ROUTING_LATENCY_SLO', default=30.0, cast=float)  # seconds, p90
+MAX_ERROR_RATE = config('ROUTING_MAX_ERROR_RATE', default=0.2, cast=float)
+MIN_SAMPLES = config('ROUTING_MIN_SAMPLES', default=10, cast=int)
+WINDOW = config('ROUTING_WINDOW', default=100, cast=int)
+# share of calls that ignore the feedback, so a demoted model gets fresh stats and can recover
+PROBE_RATE = config('ROUTING_PROBE_RATE', default=0.05, cast=float)
+
+LITE = "lite"
+STANDARD = "standard"
+LARGE = "large"
+
+MODELS = {
+    LITE: LITE_MODEL,
+    STANDARD: STANDARD_MODEL,
+    LARGE: LARGE_MODEL,
+}
+
+# model name -> recent calls as (latency in seconds, ok, total tokens)
+_calls: dict[str, deque] = {}
+_totals: dict[str, dict] = {}
+
+
+def record(model: str, latency: float, ok: bool, tokens: int = 0):
+    _calls.setdefault(model, deque(maxlen=WINDOW)).append((latency, ok, tokens))
+    totals = _totals.setdefault(model, {"calls": 0, "errors": 0, "tokens": 0})
+    totals["calls"] += 1
+    totals["errors"] += 0 if ok else 1
+    totals["tokens"] += tokens
+
+
+def _latency_p90(model: str) -> float | None:
+    latencies = [latency for latency, ok, _ in _calls.get(model, ()) if ok]
+    if len(latencies) < MIN_SAMPLES:
+        return None
+    return statistics.quantiles(latencies, n=10)[-1]
+
+
+def _error_rate(model: str) -> float | None:
+    calls = _calls.get(model, ())
+    if len(calls) < MIN_SAMPLES:
+        return None
+    return sum(1 for _, ok, _ in calls if not ok) / len(calls)
+
+
+def choose_route(nb_pages: int | None = None, template_size: int | None = None, plan: str | None = None) -> dict:
+    '''
+    Args:
+        nb_pages: pages of the document, None if unknown or not a document call
+        template_size: length of the template in characters, None when the template is being generated
+        plan: subscription plan of the caller, None if unknown (treated as Basic)
+    Returns: {"route": route name, "model": model to call first, "fallback": model to use if it is overloaded}
+    '''
+    pages = nb_pages if nb_pages is not None and nb_pages > 0 else None
+
+    if (
+        pages is not None and pages <= LITE_MAX_PAGES
+        and template_size is not None and template_size <= LITE_MAX_TEMPLATE_CHARS
+    ):
+        route = LITE
+    elif (
+        plan in LARGE_PLANS
+        and ((pages or 0) >= LARGE_MIN_PAGES or (template_size or 0) >= LARGE_MIN_TEMPLATE_CHARS)
+    ):
+        route = LARGE
+    else:
+        route = STANDARD
+
+    model = MODELS[route]
+    if random.random() >= PROBE_RATE:
+        # the large model is not worth it when it cannot meet the latency SLO
+        p90 = _latency_p90(model)
+        if route == LARGE and p90 is not None and p90 > LATENCY_SLO:
+            route = STANDARD
+            model = MODELS[route]
+
+        error_rate = _error_rate(model)
+        if error_rate is not None and error_rate >= MAX_ERROR_RATE:
+            model = FALLBACK_MODEL
+
+    return {
+        "route": route,
+        "model": model,
+        "fallback": FALLBACK_MODEL if model != FALLBACK_MODEL else None,
+    }
+
+
+def get_stats() -> dict:
+    '''
+    Returns: for each model, lifetime totals and latency/error figures over the recent window
+    '''
+    stats = {}
+    for model, totals in _totals.items():
+        latencies = [latency for latency, ok, _ in _calls[model] if ok]
+        stats[model] = {
+            **totals,
+            "latency_median": statistics.median(latencies) if latencies else None,
+            "latency_p90": _latency_p90(model),
+            "error_rate": _error_rate(model),
+        }
+    return stats
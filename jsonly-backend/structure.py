@@ -6,21 +6,72 @@ import json
 from dotenv import load_dotenv
 import logging
 import asyncio
-from datamodel_code_generator import InputFileType, generate, DataModelType
-from tempfile import NamedTemporaryFile
-import importlib
-import importlib.util
+import types as pytypes
+import uuid
 import sys
+import time
 from textwrap import dedent
 from typing import TypedDict
+from collections import OrderedDict
 import mimetypes
+from io import BytesIO
 from decouple import config
+import httpx
+import http_pool
+from cpu_pool import run_cpu, generate_model_source
+from preprocess import PDF_PREPROCESS, preprocess_pdf
+import routing
+import hedging
+from validation import parse_json, validate, sub_model
+from compaction import SCHEMA_COMPACTION, compact_schema, estimate_tokens, restore
+from templates import Template
+import fast_json
 
 
 
 logger = logging.getLogger(__name__)
 
-client = genai.Client(api_key=config('GEMINI_API_KEY'))
+client: genai.Client | None = None
+
+
+def get_client() -> genai.Client:
+    '''
+    Returns: the Gemini client, whose connection pool is kept alive and reused
+    for the lifetime of the app (created in its lifespan, or on first use)
+    '''
+    global client
+    if client is None:
+        client = genai.Client(
+            api_key=config('GEMINI_API_KEY'),
+            http_options=types.HttpOptions(async_client_args=http_pool.client_args())
+        )
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        # not available on older google-genai versions, where the pool is released with the client
+        aclose = getattr(client.aio, "aclose", None)
+        if aclose is not None:
+            await aclose()
+        client = None
+
+
+class ExtractOutput(TypedDict):
+    summary: dict
+    template: dict
+
+
+# Count the tokens of the untouched document to log how much pre-processing saved (one extra API call)
+PDF_PREPROCESS_MEASURE_SAVINGS = config('PDF_PREPROCESS_MEASURE_SAVINGS', default=False, cast=bool)
+
+# How many times the model is asked again for the fields that failed validation
+VALIDATION_MAX_REASKS = config('VALIDATION_MAX_REASKS', default=1, cast=int)
+
+# Number of templates whose generated pydantic model is kept, by template hash
+MODEL_CACHE_SIZE = config('MODEL_CACHE_SIZE', default=128, cast=int)
+
 
 async def call_gemini_with_retries(
     client: genai.Client,
@@ -34,13 +85,14 @@ async def call_gemini_with_retries(
     delay = initial_delay
     for attempt in range(1, max_retries + 1):
         try:
-            return await client.aio.models.generate_content(
+            return await hedging.generate_content(
+                client,
                 model=model,
                 contents=contents,
                 config=config
             )
         except Exception as e:
-            if e.code == 503 and attempt < max_retries:
+            if getattr(e, "code", None) == 503 and attempt < max_retries:
                 # adding jitter seems to increase success rate
                 wait = delay 
                 logger.warning(
@@ -53,7 +105,165 @@ async def call_gemini_with_retries(
             raise
 
 
-async def ai_generate_template(filepath) -> str:
+def is_model_failure(e: Exception) -> bool:
+    '''
+    Returns: True for errors that tell about the model's health (5xx, 429, timeouts),
+    False for those caused by the request itself (e.g. 400 for an invalid schema or document)
+    '''
+    if isinstance(e, (TimeoutError, httpx.TimeoutException)):
+        return True
+    code = getattr(e, "code", None)
+    return isinstance(code, int) and (code >= 500 or code == 429)
+
+
+async def call_gemini_routed(
+    client: genai.Client,
+    *,
+    route: dict,
+    contents: list,
+    config=None
+):
+    '''
+    Calls the model chosen by routing.choose_route, switching to the fallback
+    model when it stays overloaded, and feeds the outcome back to the router.
+    '''
+    models = [route["model"]] + ([route["fallback"]] if route["fallback"] else [])
+    for i, model in enumerate(models):
+        has_fallback = i < len(models) - 1
+        start = time.monotonic()
+        try:
+            response = await call_gemini_with_retries(
+                client=client,
+                model=model,
+                contents=contents,
+                # give up early on an overloaded model when another one can take the call
+                max_retries=2 if has_fallback else 5,
+                config=config
+            )
+        except Exception as e:
+            if is_model_failure(e):
+                routing.record(model, time.monotonic() - start, ok=False)
+            if getattr(e, "code", None) == 503 and has_fallback:
+                logger.warning(f"{model} overloaded; falling back to {models[i + 1]}")
+                continue
+            raise
+
+        usage = response.usage_metadata
+        tokens = (usage.total_token_count or 0) if usage is not None else 0
+        routing.record(model, time.monotonic() - start, ok=True, tokens=tokens)
+        return response
+
+
+async def load_document(filepath: str) -> dict:
+    '''
+    Returns: the document part to send to the model, pre-processed if enabled
+    '''
+    mime_type, _ = mimetypes.guess_type(filepath)
+    if not PDF_PREPROCESS or mime_type != 'application/pdf':
+        data = Path(filepath).read_bytes()
+        return {
+            'part': types.Part.from_bytes(data=data, mime_type=mime_type),
+            'data': data,
+            'mime_type': mime_type,
+            'filepath': filepath,
+            'preprocessed': False,
+        }
+
+    res = await run_cpu(preprocess_pdf, filepath)
+    if res['text'] is not None:
+        part = types.Part.from_text(text=res['text'])
+    else:
+        part = types.Part.from_bytes(data=res['pdf'], mime_type=mime_type)
+
+    if res['dropped_pages']:
+        logger.info(f"{filepath}: dropped boilerplate pages {res['dropped_pages']}")
+
+    return {
+        'part': part,
+        'data': res['pdf'],  # None when the text layer is sent
+        'mime_type': mime_type,
+        'filepath': filepath,
+        'preprocessed': True,
+    }
+
+
+async def upload_document(document: dict) -> str | None:
+    '''
+    Uploads the document to the Gemini Files API so that several calls can
+    reference it instead of each sending the full bytes. The document part is
+    replaced by a reference to the uploaded file.
+
+    Returns: the name of the uploaded file (to delete it afterwards), or None
+    if there was nothing to upload (text layer)
+    '''
+    if document['data'] is None:
+        return None
+
+    uploaded = await get_client().aio.files.upload(
+        file=BytesIO(document['data']),
+        config={'mime_type': document['mime_type']}
+    )
+    document['part'] = types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+    document['data'] = None
+    return uploaded.name
+
+
+async def report_token_usage(document: dict, response, model: str):
+    '''
+    Logs the prompt tokens of a call and, when measuring is enabled, the tokens saved by pre-processing.
+    '''
+    usage = response.usage_metadata
+    if usage is None:
+        return
+
+    if not (document['preprocessed'] and PDF_PREPROCESS_MEASURE_SAVINGS):
+        logger.info(f"{document['filepath']}: {usage.prompt_token_count} prompt tokens")
+        return
+
+    if 'original_tokens' not in document:
+        original = await get_client().aio.models.count_tokens(
+            model=model,
+            contents=[types.Part.from_bytes(
+                data=Path(document['filepath']).read_bytes(),
+                mime_type='application/pdf',
+            )]
+        )
+        document['original_tokens'] = original.total_tokens
+
+    # the prompt also holds the instructions, so this is a slight underestimate of the savings
+    saved = document['original_tokens'] - usage.prompt_token_count
+    logger.info(
+        f"{document['filepath']}: {usage.prompt_token_count} prompt tokens, "
+        f"~{saved} saved by pre-processing (document alone: {document['original_tokens']})"
+    )
+
+
+async def parse_json_or_fix(text: str, route: dict):
+    '''
+    Parses a JSON answer, repairing it locally if possible, otherwise by asking
+    the model to fix the text alone (the document is not sent again).
+    '''
+    try:
+        return parse_json(text)
+    except json.JSONDecodeError as e:
+        logger.warning(f"Malformed JSON answer ({e}); asking the model to fix it")
+
+    fix_prompt = dedent(
+        """
+        The following text should be valid JSON but is not.
+        Return the same content as valid JSON, without any explanation or extra text.
+        """
+    )
+    response = await call_gemini_routed(
+        client=get_client(),
+        route=route,
+        contents=[fix_prompt + "\n\n" + text],
+        config={"response_mime_type": "application/json"}
+    )
+    return parse_json(response.text)
+
+
+async def ai_generate_template(filepath, document: dict | None = None, nb_pages: int | None = None, plan: str | None = None) -> Template:
     '''
     Returns: a JSON structure (template) for the file
     '''
@@ -68,26 +278,27 @@ async def ai_generate_template(filepath) -> str:
         """
     )
 
-    response = await call_gemini_with_retries(
-        client=client,
-        model="gemini-2.0-flash",
+    if document is None:
+        document = await load_document(filepath)
+
+    route = routing.choose_route(nb_pages=nb_pages, plan=plan)
+    response = await call_gemini_routed(
+        client=get_client(),
+        route=route,
         contents=[
-            types.Part.from_bytes(
-                data=Path(filepath).read_bytes(),
-                mime_type='application/pdf',
-            ),
+            document['part'],
             generate_template_prompt
         ]
     )
+    await report_token_usage(document, response, route["model"])
 
-    clean_text = response.text.replace("```json", "").replace("```", "")
-    data = json.loads(clean_text)
+    data = await parse_json_or_fix(response.text, route)
     # Sort keys alphabetically
     sorted_data = {key: data[key] for key in sorted(data)}
-    return json.dumps(sorted_data, indent=2)
+    return Template(sorted_data)
 
 
-async def ai_extract_with_model(filepath:str, model_class) -> dict:
+async def ai_extract_with_model(filepath:str, model_class, document: dict | None = None, route: dict | None = None) -> dict:
     '''
     This function will be called internally by function: ai_extract
     '''
@@ -99,16 +310,17 @@ async def ai_extract_with_model(filepath:str, model_class) -> dict:
         """
     )
 
-    mime_type, _ = mimetypes.guess_type(filepath)
+    if document is None:
+        document = await load_document(filepath)
+
+    if route is None:
+        route = routing.choose_route()
 
-    response = await call_gemini_with_retries(
-        client=client,
-        model="gemini-2.0-flash",
+    response = await call_gemini_routed(
+        client=get_client(),
+        route=route,
         contents=[
-            types.Part.from_bytes(
-                data=Path(filepath).read_bytes(),
-                mime_type=mime_type,
-            ),
+            document['part'],
             extract_prompt
         ],
         config={
@@ -116,40 +328,183 @@ async def ai_extract_with_model(filepath:str, model_class) -> dict:
             "response_schema": model_class,
         }
     )
+    await report_token_usage(document, response, route["model"])
+
+    data = await parse_json_or_fix(response.text, route)
+    validated, invalid_fields = validate(model_class, data)
+
+    reasks = 0
+    while invalid_fields and reasks < VALIDATION_MAX_REASKS and isinstance(data, dict):
+        reasks += 1
+        logger.warning(f"{filepath}: fields {invalid_fields} failed validation; asking for them again")
+
+        # only the failing fields are requested, which keeps the answer (and its decoding) small
+        reask_prompt = dedent(
+            f"""
+            You will be asked to understand a document and extract only the following fields: {", ".join(invalid_fields)}.
+            Your output should be a valid JSON representation.
+            """
+        )
+        response = await call_gemini_routed(
+            client=get_client(),
+            route=route,
+            contents=[
+                document['part'],
+                reask_prompt
+            ],
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": sub_model(model_class, invalid_fields),
+            }
+        )
+        await report_token_usage(document, response, route["model"])
+
+        fields = await parse_json_or_fix(response.text, route)
+        if isinstance(fields, dict):
+            data.update(fields)
+        validated, invalid_fields = validate(model_class, data)
+
+    if validated is None:
+        # still returned, as before validation existed, rather than failing the whole extraction
+        logger.warning(f"{filepath}: fields {invalid_fields} are still invalid; returning the answer as is")
+        return data
+
+    return validated
 
-    return json.loads(response.text)
 
+# template hash -> task building the model of the template (see get_model); the
+# task itself is cached so that concurrent extractions share one code generation
+_models: OrderedDict[str, asyncio.Task] = OrderedDict()
 
-async def ai_extract(filepath:str, template:str|None) -> ExtractOutput:
+
+async def _build_model(template: Template) -> dict:
+    # the model is built from the compacted schema; answers are restored to the template's shape
+    schema = template.text
+    shape = None
+    if SCHEMA_COMPACTION:
+        compacted, shape = compact_schema(template.schema)
+        logger.info(
+            f"{template}: schema compacted from ~{estimate_tokens(template.schema)} "
+            f"to ~{estimate_tokens(compacted)} tokens"
+        )
+        schema = fast_json.dumps(compacted)
+
+    # code generation runs in the process pool; the generated module has to be
+    # executed here since the resulting classes cannot be sent back between processes
+    source = await run_cpu(generate_model_source, schema)
+
+    module_name = f"model_{uuid.uuid4().hex}"
+    module = pytypes.ModuleType(module_name)
+    # pydantic resolves annotations through sys.modules; the module stays there while cached
+    sys.modules[module_name] = module
+    try:
+        exec(compile(source, module_name, "exec"), module.__dict__)
+    except BaseException:
+        sys.modules.pop(module_name, None)
+        raise
+
+    return {
+        'model': getattr(module, "Model"),
+        'shape': shape,
+        'schema_size': len(schema),
+        'module_name': module_name,
+    }
+
+
+def _evict(task: asyncio.Task):
+    if not task.done():
+        # still building: unregistered once built
+        task.add_done_callback(_evict)
+    elif not task.cancelled() and task.exception() is None:
+        sys.modules.pop(task.result()['module_name'], None)
+    # a failed or cancelled build registered nothing
+
+
+async def get_model(template: Template) -> dict:
+    '''
+    Returns: a dict with
+        - model: the pydantic model generated for the template
+        - shape: the shape to give to restore (None without compaction)
+        - schema_size: length of the schema the model was built from
+        - module_name: the module holding the model
+    The result is cached by template hash (least recently used first out).
+    '''
+    task = _models.get(template.hash)
+    if task is None:
+        task = asyncio.ensure_future(_build_model(template))
+        _models[template.hash] = task
+        while len(_models) > MODEL_CACHE_SIZE:
+            _, evicted = _models.popitem(last=False)
+            _evict(evicted)
+    else:
+        _models.move_to_end(template.hash)
+
+    try:
+        # shielded: a cancelled extraction does not cancel a build other extractions wait for
+        return await asyncio.shield(task)
+    except Exception:
+        # not kept, so that the next extraction with this template tries again
+        if _models.get(template.hash) is task:
+            del _models[template.hash]
+        raise
+
+
+async def ai_extract(filepath:str, template: Template | None, nb_pages: int | None = None, plan: str | None = None, document: dict | None = None) -> ExtractOutput:
     '''
     Args:
         filepath: path to PDF file
-        template: schema to use as a string; if not provided, will be generated by AI
+        template: schema to use; if not provided, will be generated by AI
+        nb_pages: number of pages of the file, used to pick the model
+        plan: subscription plan of the caller, used to pick the model
+        document: already loaded document (see load_document), loaded from filepath if not provided
     '''
+    # loaded once and shared by the template generation and extraction calls
+    if document is None:
+        document = await load_document(filepath)
+
     if template is None:
-        template = await ai_generate_template(filepath)
-
-    with NamedTemporaryFile(mode='a+', suffix='.py', delete=True, delete_on_close=False) as tmp:
-        generate(
-            template,
-            input_file_type=InputFileType.JsonSchema,
-            output=Path(tmp.name),
-            output_model_type=DataModelType.PydanticV2BaseModel,
-        )
+        template = await ai_generate_template(filepath, document, nb_pages, plan)
 
-        module_name = Path(tmp.name).stem
-        spec = importlib.util.spec_from_file_location(module_name, tmp.name)
-        module = importlib.util.module_from_spec(spec)
-        sys.modules[module_name] = module  # optional: register it in sys.modules
-        spec.loader.exec_module(module)
+    built = await get_model(template)
 
-        Model = getattr(module, "Model")
+    route = routing.choose_route(nb_pages=nb_pages, template_size=built['schema_size'], plan=plan)
+    response = await ai_extract_with_model(filepath, built['model'], document, route)
 
-        response = await ai_extract_with_model(filepath, Model)
-        return {
-            'summary': response,
-            'template': json.loads(template)
-        }
+    return {
+        'summary': restore(response, built['shape']),
+        'template': template.schema
+    }
+
+
+async def ai_extract_many(filepath: str, templates: dict[str, Template], nb_pages: int | None = None, plan: str | None = None) -> dict:
+    '''
+    Extracts the same document with several templates. The document is loaded and
+    uploaded once, then all the extractions run concurrently.
+
+    Args:
+        templates: template id -> template
+    Returns: template id -> ExtractOutput, or {'error': ...} for the templates that failed
+    '''
+    document = await load_document(filepath)
+    uploaded_name = await upload_document(document)
+
+    try:
+        results = await asyncio.gather(
+            *[ai_extract(filepath, template, nb_pages, plan, document) for template in templates.values()],
+            return_exceptions=True
+        )
+    finally:
+        if uploaded_name is not None:
+            try:
+                await get_client().aio.files.delete(name=uploaded_name)
+            except Exception as e:
+                # uploaded files expire after 48 hours anyway
+                logger.warning(f"Could not delete uploaded file {uploaded_name}: {e}")
+
+    return {
+        template_id: {'error': str(res)} if isinstance(res, Exception) else res
+        for template_id, res in zip(templates.keys(), results)
+    }
 
 
 async def ai_harmonize_templates(list_of_dicts):
@@ -172,11 +527,11 @@ async def ai_harmonize_templates(list_of_dicts):
         + "\n\nHere are the input templates:\n"
         + jsons_str
     )
-    response = await call_gemini_with_retries(
-        client=client,
-        model="gemini-2.0-flash",
+    route = routing.choose_route(template_size=len(jsons_str))
+    response = await call_gemini_routed(
+        client=get_client(),
+        route=route,
         contents=[full_prompt]
     )
     
-    clean_text = response.text.replace("```json", "").replace("```", "")
-    return json.loads(clean_text)
+    return await parse_json_or_fix(response.text, route)
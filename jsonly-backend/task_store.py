@@ -0,0 +1,389 @@
+import sqlite3
+import fast_json
+import time
+from contextlib import contextmanager
+from decouple import config
+
+
+# SQLite file shared by every uvicorn worker process on the machine, so that
+# /status and /result work no matter which worker accepted the task.
+TASK_STORE_PATH = config('TASK_STORE_PATH', default='tasks.sqlite3')
+# Tasks (and their webhook deliveries) are deleted this many seconds after their last update
+TASK_TTL = config('TASK_TTL', default=7 * 24 * 3600, cast=int)
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+@contextmanager
+def _connect():
+    conn = sqlite3.connect(TASK_STORE_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def init_store():
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                owner TEXT,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                error_code INTEGER,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        # stores created before tasks had an owner
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(tasks)")]
+        if "owner" not in columns:
+            conn.execute("ALTER TABLE tasks ADD COLUMN owner TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_owner_created ON tasks (owner, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_updated ON tasks (updated_at)")
+
+
+def create_task(task_id: str, owner: str | None = None):
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO tasks (task_id, owner, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (task_id, owner, PENDING, now, now)
+        )
+
+
+def set_done(task_id: str, result) -> int:
+    '''
+    Returns: the size of the stored result in bytes
+    '''
+    serialized = fast_json.dumps(result)
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE tasks SET status = ?, result = ?, updated_at = ? WHERE task_id = ?",
+            (DONE, serialized, time.time(), task_id)
+        )
+    return len(serialized)
+
+
+def set_failed(task_id: str, error: str, error_code: int = 500):
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE tasks SET status = ?, error = ?, error_code = ?, updated_at = ? WHERE task_id = ?",
+            (FAILED, error, error_code, time.time(), task_id)
+        )
+
+
+def get_task(task_id: str, decode: bool = True) -> dict | None:
+    '''
+    Returns: the task record, or None if unknown. Its result is decoded
+    unless decode is False, in which case it is the stored JSON text.
+    '''
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+
+    if row is None:
+        return None
+
+    return _decode(row) if decode else dict(row)
+
+
+def delete_expired_tasks(before: float) -> int:
+    '''
+    Deletes the tasks not updated since before, with their finished webhook deliveries.
+    Tasks with a delivery still pending are kept until it is done.
+
+    Returns: the number of tasks deleted
+    '''
+    with _connect() as conn:
+        deleted = conn.execute(
+            "DELETE FROM tasks WHERE updated_at < ? "
+            "AND task_id NOT IN (SELECT task_id FROM deliveries WHERE status = ?) RETURNING task_id",
+            (before, PENDING)
+        ).fetchall()
+        conn.execute(
+            "DELETE FROM deliveries WHERE status != ? AND task_id NOT IN (SELECT task_id FROM tasks)",
+            (PENDING,)
+        )
+    return len(deleted)
+
+
+def _decode(row) -> dict:
+    record = dict(row)
+    if record["result"] is not None:
+        record["result"] = fast_json.loads(record["result"])
+    return record
+
+
+EXPORT_BATCH_SIZE = 100
+
+
+def iter_finished_tasks(owner: str, task_ids: list[str] | None = None, since: float | None = None, until: float | None = None):
+    '''
+    Yields the finished (done or failed) tasks of owner, oldest first, either
+    the given task_ids or those created between since and until. Rows are read
+    in small batches so that memory use does not grow with the number of tasks.
+    '''
+    if task_ids is not None:
+        for i in range(0, len(task_ids), EXPORT_BATCH_SIZE):
+            batch = task_ids[i:i + EXPORT_BATCH_SIZE]
+            placeholders = ", ".join("?" * len(batch))
+            with _connect() as conn:
+                rows = conn.execute(
+                    f"SELECT * FROM tasks WHERE owner = ? AND status != ? AND task_id IN ({placeholders}) "
+                    "ORDER BY created_at, task_id",
+                    (owner, PENDING, *batch)
+                ).fetchall()
+            for row in rows:
+                yield _decode(row)
+        return
+
+    # keyset pagination on (created_at, task_id)
+    last = (since if since is not None else float("-inf"), "")
+    while True:
+        with _connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM tasks WHERE owner = ? AND status != ? "
+                "AND (created_at > ? OR (created_at = ? AND task_id > ?)) AND created_at < ? "
+                "ORDER BY created_at, task_id LIMIT ?",
+                (owner, PENDING, last[0], last[0], last[1],
+                 until if until is not None else float("inf"), EXPORT_BATCH_SIZE)
+            ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield _decode(row)
+        last = (rows[-1]["created_at"], rows[-1]["task_id"])
+
+
+#--- Webhook deliveries
+
+def init_deliveries():
+    with _connect() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS deliveries (
+                delivery_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                owner TEXT,
+                callback_url TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                next_attempt_at REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        # stores created before retries were persisted
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(deliveries)")]
+        if "next_attempt_at" not in columns:
+            conn.execute("ALTER TABLE deliveries ADD COLUMN next_attempt_at REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS deliveries_owner ON deliveries (owner)")
+        conn.execute("CREATE INDEX IF NOT EXISTS deliveries_status ON deliveries (status)")
+
+
+def create_delivery(task_id: str, owner: str | None, callback_url: str) -> int:
+    now = time.time()
+    with _connect() as conn:
+        cursor = conn.execute(
+            "INSERT INTO deliveries (task_id, owner, callback_url, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (task_id, owner, callback_url, PENDING, now, now, now)
+        )
+        return cursor.lastrowid
+
+
+def claim_delivery(delivery_id: int, attempts: int, lease_until: float) -> bool:
+    '''
+    Atomically starts attempt number attempts + 1 of a pending delivery. Until lease_until,
+    the delivery is not re-queued on startup (after that, the attempt is considered lost).
+
+    Returns: False if the delivery is no longer pending or the attempt was already claimed
+    '''
+    with _connect() as conn:
+        cursor = conn.execute(
+            "UPDATE deliveries SET attempts = attempts + 1, next_attempt_at = ?, updated_at = ? "
+            "WHERE delivery_id = ? AND status = ? AND attempts = ?",
+            (lease_until, time.time(), delivery_id, PENDING, attempts)
+        )
+        return cursor.rowcount == 1
+
+
+def update_delivery(delivery_id: int, status: str, last_error: str | None = None, next_attempt_at: float | None = None):
+    '''
+    Args:
+        next_attempt_at: when the next attempt is due, for pending deliveries
+    '''
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE deliveries SET status = ?, last_error = ?, next_attempt_at = ?, updated_at = ? WHERE delivery_id = ?",
+            (status, last_error, next_attempt_at, time.time(), delivery_id)
+        )
+
+
+def get_pending_deliveries() -> list[dict]:
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT * FROM deliveries WHERE status = ? ORDER BY next_attempt_at",
+            (PENDING,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_delivery_stats(owner: str) -> dict:
+    '''
+    Returns: number of deliveries per status, total attempts and the most recent failures for owner
+    '''
+    with _connect() as conn:
+        rows = conn.execute(
+            "SELECT status, COUNT(*) AS nb, SUM(attempts) AS attempts FROM deliveries WHERE owner = ? GROUP BY status",
+            (owner,)
+        ).fetchall()
+        failures = conn.execute(
+            "SELECT task_id, callback_url, attempts, last_error, updated_at FROM deliveries "
+            "WHERE owner = ? AND status = ? ORDER BY updated_at DESC LIMIT 10",
+            (owner, FAILED)
+        ).fetchall()
+
+    counts = {PENDING: 0, DONE: 0, FAILED: 0}
+    total_attempts = 0
+    for row in rows:
+        counts[row["status"]] = row["nb"]
+        total_attempts += row["attempts"] or 0
+
+    return {
+        "delivered": counts[DONE],
+        "pending": counts[PENDING],
+        "failed": counts[FAILED],
+        "attempts": total_attempts,
+        "recent_failures": [dict(row) for row in failures],
+    }
+
+
+#--- Resumable uploads
+
+UPLOADING = "uploading"
+FINALIZED = "finalized"
+
+
+def init_uploads():
+    with _connect() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS uploads (
+                upload_id TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER,
+                received INTEGER NOT NULL DEFAULT 0,
+                sha256 TEXT,
+                status TEXT NOT NULL,
+                writing_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        # stores created before writes were claimed
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(uploads)")]
+        if "writing_until" not in columns:
+            conn.execute("ALTER TABLE uploads ADD COLUMN writing_until REAL")
+        conn.execute("CREATE INDEX IF NOT EXISTS uploads_updated ON uploads (updated_at)")
+
+
+def create_upload(upload_id: str, owner: str, filename: str, size: int | None):
+    now = time.time()
+    with _connect() as conn:
+        conn.execute(
+            "INSERT INTO uploads (upload_id, owner, filename, size, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (upload_id, owner, filename, size, UPLOADING, now, now)
+        )
+
+
+def claim_upload_write(upload_id: str, offset: int, lease_until: float) -> bool:
+    '''
+    Atomically reserves the upload for writing at offset, across all workers.
+    The claim lapses at lease_until (see renew_upload_write) in case its worker dies.
+
+    Returns: False if the upload is finalized, has not received exactly offset bytes,
+        or is being written by another request
+    '''
+    now = time.time()
+    with _connect() as conn:
+        cursor = conn.execute(
+            "UPDATE uploads SET writing_until = ?, updated_at = ? "
+            "WHERE upload_id = ? AND status = ? AND received = ? AND (writing_until IS NULL OR writing_until < ?)",
+            (lease_until, now, upload_id, UPLOADING, offset, now)
+        )
+        return cursor.rowcount == 1
+
+
+def renew_upload_write(upload_id: str, lease_until: float):
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE uploads SET writing_until = ?, updated_at = ? WHERE upload_id = ?",
+            (lease_until, time.time(), upload_id)
+        )
+
+
+def set_upload_received(upload_id: str, received: int):
+    '''
+    Records the bytes received and releases the write claim.
+    '''
+    with _connect() as conn:
+        conn.execute(
+            "UPDATE uploads SET received = ?, writing_until = NULL, updated_at = ? WHERE upload_id = ?",
+            (received, time.time(), upload_id)
+        )
+
+
+def set_upload_finalized(upload_id: str, received: int, sha256: str) -> bool:
+    '''
+    Returns: False if the upload changed since received was read (a chunk is being written)
+    '''
+    now = time.time()
+    with _connect() as conn:
+        cursor = conn.execute(
+            "UPDATE uploads SET status = ?, sha256 = ?, updated_at = ? "
+            "WHERE upload_id = ? AND status = ? AND received = ? AND (writing_until IS NULL OR writing_until < ?)",
+            (FINALIZED, sha256, now, upload_id, UPLOADING, received, now)
+        )
+        return cursor.rowcount == 1
+
+
+def touch_upload(upload_id: str):
+    with _connect() as conn:
+        conn.execute("UPDATE uploads SET updated_at = ? WHERE upload_id = ?", (time.time(), upload_id))
+
+
+def delete_expired_uploads(before: float) -> list[str]:
+    '''
+    Deletes the uploads not updated since before, except those being written.
+
+    Returns: the ids of the deleted uploads
+    '''
+    now = time.time()
+    with _connect() as conn:
+        rows = conn.execute(
+            "DELETE FROM uploads WHERE updated_at < ? AND (writing_until IS NULL OR writing_until < ?) "
+            "RETURNING upload_id",
+            (before, now)
+        ).fetchall()
+    return [row["upload_id"] for row in rows]
+
+
+def get_upload(upload_id: str) -> dict | None:
+    with _connect() as conn:
+        row = conn.execute("SELECT * FROM uploads WHERE upload_id = ?", (upload_id,)).fetchone()
+    return dict(row) if row is not None else None
@@ -0,0 +1,37 @@
+import hashlib
+import fast_json
+
+
+class Template:
+    '''
+    A template parsed once, whatever form it came in (generated, or saved in Firestore
+    as a JSON string or a map), with its JSON text and a stable hash computed up front.
+
+    Attributes:
+        schema: the template as a dict, in its original key order
+        text: the schema as compact JSON, in the same order (input of the code generation)
+        hash: sha256 of the schema with sorted keys, so that formatting and key order do not change it
+    '''
+    __slots__ = ("schema", "text", "hash")
+
+    def __init__(self, schema: dict):
+        if not isinstance(schema, dict):
+            raise ValueError("A template must be a JSON object.")
+        self.schema = schema
+        self.text = fast_json.dumps(schema)
+        self.hash = hashlib.sha256(fast_json.dumps(schema, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def load(cls, value) -> "Template":
+        '''
+        Args:
+            value: a Template, a dict, or JSON text
+        '''
+        if isinstance(value, Template):
+            return value
+        if isinstance(value, (str, bytes)):
+            value = fast_json.loads(value)
+        return cls(value)
+
+    def __repr__(self) -> str:
+        return f"Template({self.hash[:12]}, {len(self.text)} chars)"
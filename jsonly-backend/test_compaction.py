@@ -0,0 +1,121 @@
+import json
+import sys
+import types
+
+import compaction
+from compaction import compact_schema, restore
+from cpu_pool import generate_model_source
+from validation import validate
+
+
+compaction.SCHEMA_MIN_SHARED_CHARS = 50
+
+address = {
+    "type": "object",
+    "properties": {
+        "street": {"type": "string", "description": "Street and number"},
+        "city": {"type": "string"},
+        "zip": {"type": "string"},
+    },
+}
+
+schema = {
+    "type": "object",
+    "properties": {
+        "account-number": {"type": "string", "description": "Account number " * 20},
+        "billing": {
+            "type": "object",
+            "properties": {
+                "period": {
+                    "type": "object",
+                    "properties": {"start": {"type": "string"}},
+                    "required": ["start"],
+                },
+            },
+            "required": ["period"],
+        },
+        "billing__period__start": {"type": "string"},
+        "customer": {
+            "type": "object",
+            "properties": {
+                "name": {"type": "string"},
+                "address": address,
+                "shipping": address,
+            },
+        },
+        "lines": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "amount": {
+                        "type": "object",
+                        "properties": {"value": {"type": "number"}},
+                    },
+                },
+            },
+        },
+    },
+}
+
+value = {
+    "account-number": "123",
+    "billing": {"period": {"start": "2025-01-01"}},
+    "billing__period__start": "monthly",
+    "customer": {
+        "name": "Jane",
+        "address": {"street": "1 Main St", "city": "Springfield", "zip": "12345"},
+        "shipping": {"street": "2 Side St", "city": "Shelbyville", "zip": "67890"},
+    },
+    "lines": [{"amount": {"value": 10.5}}, {"amount": {"value": 2.0}}],
+}
+
+
+def flatten(value, shape):
+    '''
+    Inverse of restore: the value as the model of the compacted schema returns it.
+    '''
+    if shape is None:
+        return value
+    if "items" in shape:
+        return [flatten(item, shape["items"]) for item in value]
+
+    flat = dict(value)
+    for key, (path, sub_shape) in shape["properties"].items():
+        sub = value
+        for name in path:
+            sub = sub[name]
+        flat.pop(path[0], None)
+        flat[key] = flatten(sub, sub_shape)
+    return flat
+
+
+# compaction
+compacted, shape = compact_schema(schema)
+print(json.dumps(compacted, indent=2))
+
+properties = compacted["properties"]
+# flattening billing would collide with the billing__period__start property: it stays nested
+assert "billing" in properties and properties["billing__period__start"] == {"type": "string"}
+assert "lines" in properties and "amount__value" in properties["lines"]["items"]["properties"]
+assert len(properties["account-number"]["description"]) <= compaction.SCHEMA_MAX_DESCRIPTION_CHARS + 3
+
+shared = compacted["$defs"]["Shared1"]
+assert list(shared["properties"]) == ["street", "city", "zip"], "shared definitions keep the key order"
+customer = properties["customer"]["properties"]
+assert customer["address"] == customer["shipping"] == {"$ref": "#/$defs/Shared1"}
+
+# round trip through the generated model
+source = generate_model_source(json.dumps(compacted))
+module = types.ModuleType("test_compaction_model")
+sys.modules[module.__name__] = module
+exec(compile(source, module.__name__, "exec"), module.__dict__)
+
+answer = json.loads(json.dumps(flatten(value, shape)))
+validated, invalid_fields = validate(module.Model, answer)
+assert invalid_fields == [], invalid_fields
+assert restore(validated, shape) == value, restore(validated, shape)
+assert list(validated["customer"]["address"]) == ["street", "city", "zip"]
+
+assert restore(value, None) is value
+print("compaction: OK")
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import types
+
+# settings are read when the module is imported
+os.environ["GEMINI_HEDGING"] = "true"
+os.environ["HEDGE_PERCENTILE"] = "90"
+os.environ["HEDGE_BUDGET"] = "0.5"
+os.environ["HEDGE_MIN_SAMPLES"] = "10"
+
+import hedging
+
+
+class Models:
+    '''
+    Stands in for client.aio.models: every call takes the next delay of self.delays.
+    '''
+    def __init__(self):
+        self.delays = []
+        self.calls = 0
+
+    async def generate_content(self, model, contents, config=None):
+        number = self.calls
+        self.calls += 1
+        await asyncio.sleep(self.delays.pop(0))
+        return f"answer {number}"
+
+
+async def main():
+    models = Models()
+    client = types.SimpleNamespace(aio=types.SimpleNamespace(models=models))
+
+    async def call():
+        return await hedging.generate_content(client, model="m", contents=[])
+
+    # no hedging until enough latencies were observed
+    models.delays = [0.01 * i for i in range(1, 11)]
+    for _ in range(10):
+        assert (await call()).startswith("answer")
+    assert hedging._stats["hedges_issued"] == 0 and models.calls == 10
+    delay = hedging._hedge_delay("m")
+    assert 0.09 <= delay <= 0.1, delay
+
+    # a slow call gets a duplicate request, which answers first
+    models.delays = [1.0, 0.01]
+    assert await call() == "answer 11"
+    assert hedging._stats["hedges_issued"] == 1 and hedging._stats["hedges_won"] == 1
+
+    # fast calls are not hedged
+    models.delays = [0.01]
+    assert await call() == "answer 12"
+    assert hedging._stats["hedges_issued"] == 1
+
+    # the budget caps the extra calls: with this call, 1 hedge for 2 calls is already 50%
+    hedging._stats["calls"] = 1
+    models.delays = [0.3]
+    assert await call() == "answer 13"
+    assert hedging._stats["hedges_issued"] == 1
+    print("hedging: OK")
+
+
+asyncio.run(main())
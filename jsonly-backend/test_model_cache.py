@@ -0,0 +1,75 @@
+import asyncio
+import sys
+
+import cpu_pool
+import structure
+from templates import Template
+
+
+def template(name: str) -> Template:
+    return Template({"type": "object", "properties": {name: {"type": "string"}}})
+
+
+async def main():
+    structure.MODEL_CACHE_SIZE = 1
+
+    # same template (whatever the key order): a single build, shared by concurrent extractions
+    builds = []
+    build_model = structure._build_model
+
+    async def counting_build(t):
+        builds.append(t.hash)
+        return await build_model(t)
+
+    structure._build_model = counting_build
+    same = [
+        Template({"type": "object", "properties": {"a": {"type": "string"}}}),
+        Template({"properties": {"a": {"type": "string"}}, "type": "object"}),
+    ]
+    built = await asyncio.gather(*[structure.get_model(same[i % 2]) for i in range(4)])
+    assert len(builds) == 1, builds
+    assert len({id(b["model"]) for b in built}) == 1
+    module_name = built[0]["module_name"]
+    assert module_name in sys.modules
+
+    # evicted by another template: the module is unregistered
+    await structure.get_model(template("b"))
+    assert module_name not in sys.modules
+    assert len(structure._models) == 1
+
+    # a build that fails after being evicted must not make _evict run again and again
+    evictions = []
+    evict = structure._evict
+
+    def counting_evict(task):
+        evictions.append(task)
+        evict(task)
+
+    structure._evict = counting_evict
+
+    async def failing_build(t):
+        await asyncio.sleep(0.05)
+        raise RuntimeError("codegen failed")
+
+    structure._build_model = failing_build
+    failing = asyncio.ensure_future(structure.get_model(template("c")))
+    await asyncio.sleep(0)
+    structure._build_model = counting_build
+    await structure.get_model(template("d"))  # evicts the running build of "c"
+    try:
+        await failing
+        raise AssertionError("the build should fail")
+    except RuntimeError:
+        pass
+    await asyncio.sleep(0.2)
+    # "b" evicted by "c", "c" evicted by "d", then once more when the build of "c" fails
+    assert len(evictions) == 3, f"_evict called {len(evictions)} times"
+    assert template("c").hash not in structure._models
+
+    print("model cache: OK")
+
+
+if __name__ == '__main__':
+    # the CPU pool spawns processes, which import this module again
+    asyncio.run(main())
+    cpu_pool.shutdown_pool()
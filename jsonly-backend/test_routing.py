@@ -0,0 +1,72 @@
+import asyncio
+import types
+
+import routing
+import structure
+
+
+class ApiError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+def fake_client(outcomes: dict):
+    '''
+    Client whose calls to a model raise outcomes[model] if it is an exception, or answer with it.
+    '''
+    async def generate_content(*, model, contents, config=None):
+        outcome = outcomes[model]
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return types.SimpleNamespace(text=outcome, usage_metadata=None)
+
+    return types.SimpleNamespace(aio=types.SimpleNamespace(models=types.SimpleNamespace(generate_content=generate_content)))
+
+
+async def call(client, model, fallback=None):
+    route = {"route": routing.STANDARD, "model": model, "fallback": fallback}
+    return await structure.call_gemini_routed(client, route=route, contents=["x"])
+
+
+async def main():
+    routing.PROBE_RATE = 0
+
+    # route selection
+    assert routing.choose_route(nb_pages=1, template_size=100)["route"] == routing.LITE
+    assert routing.choose_route(nb_pages=1, template_size=None)["route"] == routing.STANDARD
+    assert routing.choose_route(nb_pages=30, template_size=100, plan="Basic")["route"] == routing.STANDARD
+    assert routing.choose_route(nb_pages=30, template_size=100, plan="Pro")["route"] == routing.LARGE
+
+    # a timeout is recorded against the model, and the original error reaches the caller
+    try:
+        await call(fake_client({"slow": TimeoutError("timed out")}), "slow")
+        raise AssertionError("the call should fail")
+    except TimeoutError:
+        pass
+    assert routing.get_stats()["slow"]["errors"] == 1, routing.get_stats()
+
+    # errors caused by the request are not the model's
+    try:
+        await call(fake_client({"strict": ApiError(400)}), "strict")
+        raise AssertionError("the call should fail")
+    except ApiError:
+        pass
+    assert "strict" not in routing.get_stats(), routing.get_stats()
+
+    # an overloaded model falls back, and both outcomes are recorded
+    answer = await call(fake_client({"busy": ApiError(503), "spare": "{}"}), "busy", fallback="spare")
+    assert answer.text == "{}"
+    stats = routing.get_stats()
+    assert stats["busy"]["errors"] == 1 and stats["spare"]["errors"] == 0, stats
+
+    # a model failing too often is replaced by the fallback model
+    for _ in range(routing.MIN_SAMPLES):
+        routing.record(routing.STANDARD_MODEL, 1.0, ok=False)
+    assert routing.choose_route(nb_pages=5)["model"] == routing.FALLBACK_MODEL
+
+    print("routing: OK")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
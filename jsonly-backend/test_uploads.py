@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+
+# settings are read when the modules are imported
+directory = tempfile.mkdtemp()
+os.environ["TASK_STORE_PATH"] = os.path.join(directory, "tasks.sqlite3")
+os.environ["UPLOAD_DIR"] = os.path.join(directory, "uploads")
+os.environ["UPLOAD_TTL"] = "3600"
+
+import task_store
+import uploads
+from uploads import UploadError
+
+
+data = os.urandom(3 * 1024 * 1024 + 123)
+
+
+async def stream(*chunks: bytes):
+    for chunk in chunks:
+        await asyncio.sleep(0)
+        yield chunk
+
+
+def expect_error(status_code: int, function, *args):
+    try:
+        result = function(*args)
+        if asyncio.iscoroutine(result):
+            asyncio.run(result)
+    except UploadError as e:
+        assert e.status_code == status_code, (e.status_code, e.detail)
+        return e.detail
+    raise AssertionError(f"{function.__name__} should fail with {status_code}")
+
+
+task_store.init_store()
+uploads.init_uploads()
+
+# chunks in order, the hash covers every byte
+upload = uploads.create_upload("owner", "big.pdf", len(data))
+upload_id = upload["upload_id"]
+assert upload["received"] == 0 and upload["status"] == task_store.UPLOADING
+
+upload = asyncio.run(uploads.write_chunk(upload_id, "owner", 0, stream(data[:1000], data[1000:2000000])))
+assert upload["received"] == 2000000 and upload["writing_until"] is None
+
+# wrong offsets, other owners, early finalization
+assert "Expected offset 2000000" in expect_error(409, uploads.write_chunk, upload_id, "owner", 1000, stream(b"x"))
+expect_error(404, uploads.write_chunk, upload_id, "someone else", 2000000, stream(b"x"))
+assert "Received 2000000" in expect_error(409, uploads.finalize_upload, upload_id, "owner")
+
+# a chunk being written holds the upload
+assert task_store.claim_upload_write(upload_id, 2000000, time.time() + 60)
+assert "being written" in expect_error(409, uploads.write_chunk, upload_id, "owner", 2000000, stream(b"x"))
+assert task_store.delete_expired_uploads(time.time() + 1) == []
+# until the claim lapses
+task_store.renew_upload_write(upload_id, time.time() - 1)
+
+# a resumed upload on a worker without the cached hash rebuilds it from the file
+uploads._hashers.clear()
+upload = asyncio.run(uploads.write_chunk(upload_id, "owner", 2000000, stream(data[2000000:])))
+assert upload["received"] == len(data)
+expect_error(413, uploads.write_chunk, upload_id, "owner", len(data), stream(b"x"))
+
+upload = uploads.finalize_upload(upload_id, "owner")
+assert upload["status"] == task_store.FINALIZED
+assert upload["sha256"] == hashlib.sha256(data).hexdigest()
+assert uploads.finalize_upload(upload_id, "owner")["sha256"] == upload["sha256"]
+assert "already finalized" in expect_error(409, uploads.write_chunk, upload_id, "owner", len(data), stream(b"x"))
+
+path, filename = uploads.get_finalized_path(upload_id, "owner")
+assert filename == "big.pdf" and path.read_bytes() == data
+print("chunks: OK")
+
+# uploads without a declared size
+other = uploads.create_upload("owner", "small.pdf", None)["upload_id"]
+expect_error(400, uploads.finalize_upload, other, "owner")
+asyncio.run(uploads.write_chunk(other, "owner", 0, stream(b"%PDF-1.4")))
+assert uploads.finalize_upload(other, "owner")["sha256"] == hashlib.sha256(b"%PDF-1.4").hexdigest()
+expect_error(413, uploads.create_upload, "owner", "huge.pdf", uploads.UPLOAD_MAX_BYTES + 1)
+print("sizes: OK")
+
+# expired uploads are deleted with their files, recent ones are kept
+with task_store._connect() as conn:
+    conn.execute("UPDATE uploads SET updated_at = ? WHERE upload_id = ?", (time.time() - 7200, other))
+orphan = uploads.UPLOAD_DIR / "orphan.pdf"
+orphan.write_bytes(b"x")
+os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+
+assert uploads.sweep() == 1
+assert task_store.get_upload(other) is None and not uploads.upload_path(other).exists()
+assert not orphan.exists()
+assert uploads.get_finalized_path(upload_id, "owner")[0].exists()
+print("sweep: OK")
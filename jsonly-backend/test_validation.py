@@ -0,0 +1,67 @@
+import json
+
+from pydantic import BaseModel, Field
+
+from validation import parse_json, sub_model, validate
+
+
+# parse_json repairs
+assert parse_json('{"a": 1}') == {"a": 1}
+assert parse_json('```json\n{"a": 1}\n```') == {"a": 1}
+assert parse_json('```\n[1, 2]\n```') == [1, 2]
+assert parse_json('Here is the JSON you asked for: {"a": {"b": 2}} Hope it helps!') == {"a": {"b": 2}}
+assert parse_json('{"a": [1, 2,], "b": 3,}') == {"a": [1, 2], "b": 3}
+assert parse_json('Sure:\n```json\n{"a": [1, 2,],}\n```') == {"a": [1, 2]}
+try:
+    parse_json("no json here")
+    raise AssertionError("parse_json should fail")
+except json.JSONDecodeError:
+    pass
+print("parse_json: OK")
+
+
+class Amount(BaseModel):
+    value: float
+    currency: str
+
+
+class Model(BaseModel):
+    account_number: str = Field(alias="account-number")
+    total: Amount
+    notes: str | None = None
+
+
+# valid answers are returned as the model dumps them, by alias
+answer = {"account-number": "123", "total": {"value": "10.5", "currency": "USD"}}
+validated, invalid_fields = validate(Model, answer)
+assert invalid_fields == []
+assert validated == {"account-number": "123", "total": {"value": 10.5, "currency": "USD"}}, validated
+
+# invalid fields are reported by alias, once each
+validated, invalid_fields = validate(Model, {"total": {"value": "ten"}})
+assert validated is None and invalid_fields == ["account-number", "total"], invalid_fields
+
+# a value that is not an object fails every field
+validated, invalid_fields = validate(Model, ["not", "an", "object"])
+assert validated is None and invalid_fields == ["account-number", "total", "notes"], invalid_fields
+print("validate: OK")
+
+# re-ask: only the failing fields are requested, then merged into the first answer
+answer = {"account-number": 123, "total": {"value": 10.5, "currency": "USD"}, "notes": "paid"}
+validated, invalid_fields = validate(Model, answer)
+assert validated is None and invalid_fields == ["account-number"]
+
+Fields = sub_model(Model, invalid_fields)
+assert list(Fields.model_fields) == ["account_number"]
+assert Fields.model_fields["account_number"].alias == "account-number"
+assert list(Fields.model_json_schema()["properties"]) == ["account-number"]
+
+reask_answer = {"account-number": "123"}
+assert validate(Fields, reask_answer) == (reask_answer, [])
+answer.update(reask_answer)
+validated, invalid_fields = validate(Model, answer)
+assert invalid_fields == [] and validated["account-number"] == "123" and validated["notes"] == "paid"
+
+# fields are also found by their Python name
+assert list(sub_model(Model, ["account_number", "total"]).model_fields) == ["account_number", "total"]
+print("re-ask: OK")
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import tempfile
+import time
+
+# settings are read when the modules are imported
+os.environ["TASK_STORE_PATH"] = os.path.join(tempfile.mkdtemp(), "tasks.sqlite3")
+os.environ["WEBHOOK_INITIAL_DELAY"] = "0.05"
+os.environ["WEBHOOK_MAX_ATTEMPTS"] = "3"
+
+import httpx
+
+import task_store
+import webhooks
+
+
+SECRET = "s3cret"
+PUBLIC_ADDRESS = "93.184.216.34"
+
+requests = []
+responses = []
+resolutions = []
+
+
+def handler(request: httpx.Request) -> httpx.Response:
+    requests.append(request)
+    return httpx.Response(responses.pop(0) if responses else 200)
+
+
+async def resolve_host(host, port):
+    resolutions.append(host)
+    # the first resolution passes the check, later ones point to the metadata server
+    return [PUBLIC_ADDRESS] if len(resolutions) == 1 else ["169.254.169.254"]
+
+
+def get_delivery(delivery_id: int) -> dict:
+    with task_store._connect() as conn:
+        return dict(conn.execute("SELECT * FROM deliveries WHERE delivery_id = ?", (delivery_id,)).fetchone())
+
+
+async def wait_for(delivery_id: int, status: str):
+    for _ in range(100):
+        if get_delivery(delivery_id)["status"] == status:
+            return
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"delivery {delivery_id} is {get_delivery(delivery_id)}, expected {status}")
+
+
+def finished_task(task_id: str) -> str:
+    task_store.create_task(task_id, "owner")
+    task_store.set_done(task_id, {"total": 42})
+    return task_id
+
+
+async def main():
+    task_store.init_store()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    await webhooks.start(client, lambda owner: SECRET if owner == "owner" else None)
+
+    # refused URLs
+    webhooks._resolve_host = resolve_host
+    assert await webhooks.check_callback_url("ftp://hooks.example.com/") is not None
+    assert await webhooks.check_callback_url("http://metadata.google.internal/") is not None
+    resolutions.append("first")  # every later resolution is private
+    assert await webhooks.check_callback_url("https://hooks.example.com/") is not None
+    resolutions.clear()
+
+    # signed delivery, pinned to the address that was checked
+    task_id = finished_task("t1")
+    webhooks.enqueue(task_id, "owner", "https://hooks.example.com:8443/jsonly?x=1")
+    delivery_id = get_delivery_id(task_id)
+    await wait_for(delivery_id, task_store.DONE)
+    assert len(resolutions) == 1, resolutions
+    request = requests.pop()
+    assert request.url.host == PUBLIC_ADDRESS and request.url.port == 8443, request.url
+    assert request.url.path == "/jsonly" and request.url.query == b"x=1", request.url
+    assert request.headers["Host"] == "hooks.example.com:8443"
+    assert request.extensions["sni_hostname"] == "hooks.example.com"
+    timestamp = request.headers["X-Jsonly-Timestamp"]
+    assert abs(int(timestamp) - time.time()) < 5
+    assert request.headers["X-Jsonly-Signature"] == f"sha256={webhooks.sign(request.content, timestamp, SECRET)}"
+    assert b'"total":42' in request.content
+    print("signature and pinning: OK")
+
+    # a host that resolves to a private address at delivery time is not called
+    task_id = finished_task("t2")
+    webhooks.enqueue(task_id, "owner", "https://hooks.example.com/")
+    delivery_id = get_delivery_id(task_id)
+    await wait_for(delivery_id, task_store.FAILED)
+    assert requests == [] and "refused" in get_delivery(delivery_id)["last_error"]
+    print("rebinding: OK")
+
+    # server errors are retried, client errors are not
+    resolutions.clear()
+    webhooks._resolve_host = lambda host, port: asyncio.sleep(0, [PUBLIC_ADDRESS])
+    responses.extend([503, 503])
+    task_id = finished_task("t3")
+    webhooks.enqueue(task_id, "owner", "http://hooks.example.com/")
+    delivery_id = get_delivery_id(task_id)
+    await wait_for(delivery_id, task_store.DONE)
+    assert get_delivery(delivery_id)["attempts"] == 3 and len(requests) == 3
+    assert "Host" in requests[0].headers and "sni_hostname" not in requests[0].extensions
+    requests.clear()
+
+    responses.extend([503, 503, 503])
+    task_id = finished_task("t4")
+    webhooks.enqueue(task_id, "owner", "http://hooks.example.com/")
+    delivery_id = get_delivery_id(task_id)
+    await wait_for(delivery_id, task_store.FAILED)
+    assert get_delivery(delivery_id)["attempts"] == 3 and get_delivery(delivery_id)["last_error"] == "HTTP 503"
+    requests.clear()
+
+    responses.append(400)
+    task_id = finished_task("t5")
+    webhooks.enqueue(task_id, "owner", "http://hooks.example.com/")
+    delivery_id = get_delivery_id(task_id)
+    await wait_for(delivery_id, task_store.FAILED)
+    assert get_delivery(delivery_id)["attempts"] == 1 and len(requests) == 1
+    requests.clear()
+
+    # tasks without an owner secret are not sent
+    task_id = finished_task("t6")
+    webhooks.enqueue(task_id, None, "http://hooks.example.com/")
+    await wait_for(get_delivery_id(task_id), task_store.FAILED)
+    assert requests == []
+    print("retries: OK")
+
+    # deliveries still pending in the store are re-queued on startup
+    await webhooks.stop()
+    task_id = finished_task("t7")
+    delivery_id = task_store.create_delivery(task_id, "owner", "http://hooks.example.com/")
+    await webhooks.start(client, lambda owner: SECRET)
+    await wait_for(delivery_id, task_store.DONE)
+    assert len(requests) == 1
+    print("re-queue: OK")
+
+    await webhooks.stop()
+    await client.aclose()
+
+
+def get_delivery_id(task_id: str) -> int:
+    with task_store._connect() as conn:
+        return conn.execute("SELECT delivery_id FROM deliveries WHERE task_id = ?", (task_id,)).fetchone()[0]
+
+
+asyncio.run(main())
@@ -0,0 +1,203 @@
+from pathlib import Path
+import asyncio
+import hashlib
+import logging
+import time
+import uuid
+from decouple import config
+import task_store
+
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(config('UPLOAD_DIR', default='uploads'))
+UPLOAD_MAX_BYTES = config('UPLOAD_MAX_BYTES', default=100 * 1024 * 1024, cast=int)
+# Uploads (finalized or not) are deleted after this many seconds without activity
+UPLOAD_TTL = config('UPLOAD_TTL', default=24 * 3600, cast=int)
+UPLOAD_SWEEP_INTERVAL = config('UPLOAD_SWEEP_INTERVAL', default=600, cast=int)
+# A chunk being written holds the upload for this many seconds, renewed while data arrives
+UPLOAD_WRITE_LEASE = config('UPLOAD_WRITE_LEASE', default=60, cast=int)
+
+_BLOCK_SIZE = 1024 * 1024
+
+# upload id -> (offset, sha256 of the bytes before offset). Chunks usually hit
+# the same worker; otherwise the hash is rebuilt from the file on disk.
+_hashers: dict[str, tuple[int, "hashlib._Hash"]] = {}
+_sweeper: asyncio.Task | None = None
+
+
+class UploadError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def init_uploads():
+    UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    task_store.init_uploads()
+
+
+def upload_path(upload_id: str) -> Path:
+    return UPLOAD_DIR / f"{upload_id}.pdf"
+
+
+def create_upload(owner: str, filename: str, size: int | None) -> dict:
+    if size is not None and size > UPLOAD_MAX_BYTES:
+        raise UploadError(413, f"File too large. The maximum size is {UPLOAD_MAX_BYTES} bytes.")
+
+    upload_id = str(uuid.uuid4())
+    upload_path(upload_id).touch()
+    task_store.create_upload(upload_id, owner, filename, size)
+    _hashers[upload_id] = (0, hashlib.sha256())
+    return task_store.get_upload(upload_id)
+
+
+def get_upload(upload_id: str, owner: str) -> dict:
+    upload = task_store.get_upload(upload_id)
+    # uploads of other clients are reported as missing
+    if upload is None or upload["owner"] != owner:
+        raise UploadError(404, f"Upload id {upload_id} was not found.")
+    return upload
+
+
+def _hasher_at(upload_id: str, offset: int):
+    cached = _hashers.get(upload_id)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+
+    hasher = hashlib.sha256()
+    remaining = offset
+    with open(upload_path(upload_id), "rb") as f:
+        while remaining > 0:
+            block = f.read(min(_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+async def write_chunk(upload_id: str, owner: str, offset: int, stream) -> dict:
+    '''
+    Appends the bytes of stream to the upload, starting at offset, which must
+    be the number of bytes received so far. The bytes are written to disk and
+    hashed as they arrive; if the connection drops, what was written is kept.
+
+    Returns: the upload record
+    '''
+    upload = get_upload(upload_id, owner)
+    # claimed in the store, since chunks of the same upload may reach different workers
+    if not task_store.claim_upload_write(upload_id, offset, time.time() + UPLOAD_WRITE_LEASE):
+        upload = get_upload(upload_id, owner)
+        if upload["status"] != task_store.UPLOADING:
+            raise UploadError(409, f"Upload id {upload_id} is already finalized.")
+        if offset != upload["received"]:
+            raise UploadError(409, f"Expected offset {upload['received']}, got {offset}.")
+        raise UploadError(409, f"Another chunk of upload id {upload_id} is being written.")
+
+    limit = upload["size"] if upload["size"] is not None else UPLOAD_MAX_BYTES
+    hasher = _hasher_at(upload_id, offset)
+    received = offset
+    renew_at = time.monotonic() + UPLOAD_WRITE_LEASE / 2
+    try:
+        with open(upload_path(upload_id), "r+b") as f:
+            f.seek(offset)
+            f.truncate()
+            async for chunk in stream:
+                if received + len(chunk) > limit:
+                    raise UploadError(413, f"Upload exceeds its size of {limit} bytes.")
+                f.write(chunk)
+                hasher.update(chunk)
+                received += len(chunk)
+                if time.monotonic() >= renew_at:
+                    task_store.renew_upload_write(upload_id, time.time() + UPLOAD_WRITE_LEASE)
+                    renew_at = time.monotonic() + UPLOAD_WRITE_LEASE / 2
+    finally:
+        _hashers[upload_id] = (received, hasher)
+        # also releases the claim
+        task_store.set_upload_received(upload_id, received)
+
+    return task_store.get_upload(upload_id)
+
+
+def finalize_upload(upload_id: str, owner: str) -> dict:
+    '''
+    Marks the upload as complete and records its SHA-256.
+
+    Returns: the upload record
+    '''
+    upload = get_upload(upload_id, owner)
+    if upload["status"] == task_store.FINALIZED:
+        return upload
+    if upload["size"] is not None and upload["received"] != upload["size"]:
+        raise UploadError(409, f"Received {upload['received']} of {upload['size']} bytes.")
+    if upload["received"] == 0:
+        raise UploadError(400, "Upload is empty.")
+
+    sha256 = _hasher_at(upload_id, upload["received"]).hexdigest()
+    if not task_store.set_upload_finalized(upload_id, upload["received"], sha256):
+        raise UploadError(409, f"A chunk of upload id {upload_id} is being written.")
+    _hashers.pop(upload_id, None)
+    return task_store.get_upload(upload_id)
+
+
+def get_finalized_path(upload_id: str, owner: str) -> tuple[Path, str]:
+    '''
+    Returns: (path of the uploaded file, its original filename)
+    '''
+    upload = get_upload(upload_id, owner)
+    if upload["status"] != task_store.FINALIZED:
+        raise UploadError(409, f"Upload id {upload_id} is not finalized.")
+    # in use: restarts its time to live
+    task_store.touch_upload(upload_id)
+    return upload_path(upload_id), upload["filename"]
+
+
+def sweep() -> int:
+    '''
+    Deletes the uploads without activity for UPLOAD_TTL seconds: their rows, files and cached hashes.
+
+    Returns: the number of uploads deleted
+    '''
+    cutoff = time.time() - UPLOAD_TTL
+    expired = task_store.delete_expired_uploads(cutoff)
+    for upload_id in expired:
+        upload_path(upload_id).unlink(missing_ok=True)
+        _hashers.pop(upload_id, None)
+
+    # hashes of uploads deleted by another worker
+    for upload_id in list(_hashers):
+        if task_store.get_upload(upload_id) is None:
+            _hashers.pop(upload_id, None)
+
+    # files left behind by a worker that stopped between deleting the row and the file
+    for path in UPLOAD_DIR.glob("*.pdf"):
+        if path.stat().st_mtime < cutoff and task_store.get_upload(path.stem) is None:
+            path.unlink(missing_ok=True)
+
+    return len(expired)
+
+
+async def _sweep_periodically():
+    while True:
+        try:
+            deleted = sweep()
+            if deleted:
+                logger.info(f"Deleted {deleted} expired uploads")
+        except Exception as e:
+            logger.exception(f"Could not delete expired uploads: {e}")
+        await asyncio.sleep(UPLOAD_SWEEP_INTERVAL)
+
+
+def start_sweeper():
+    global _sweeper
+    _sweeper = asyncio.create_task(_sweep_periodically())
+
+
+async def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        await asyncio.gather(_sweeper, return_exceptions=True)
+        _sweeper = None
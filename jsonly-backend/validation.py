@@ -0,0 +1,67 @@
+from pydantic import BaseModel, ValidationError, create_model
+import json
+import re
+
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def parse_json(text: str):
+    '''
+    Parses a model answer as JSON, repairing the usual defects locally:
+    markdown code fences, text around the JSON value, trailing commas.
+
+    Raises: json.JSONDecodeError if the text cannot be repaired
+    '''
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+
+    # keep the outermost object or array only
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    end = max(text.rfind("}"), text.rfind("]"))
+    if starts and end > min(starts):
+        text = text[min(starts):end + 1]
+
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return json.loads(_TRAILING_COMMA.sub(r"\1", text))
+
+
+def validate(model_class: type[BaseModel], data) -> tuple[dict | None, list[str]]:
+    '''
+    Returns: (the data as validated by model_class, []) if valid,
+        otherwise (None, aliases of the top-level fields that are missing or invalid)
+    '''
+    try:
+        instance = model_class.model_validate(data)
+    except ValidationError as e:
+        fields = []
+        for error in e.errors():
+            loc = error["loc"]
+            # an error without location means the whole value is wrong (e.g. not an object)
+            if not loc:
+                return None, [field.alias or name for name, field in model_class.model_fields.items()]
+            if loc[0] not in fields:
+                fields.append(loc[0])
+        return None, fields
+
+    return instance.model_dump(mode="json", by_alias=True, exclude_unset=True), []
+
+
+def sub_model(model_class: type[BaseModel], fields: list[str]) -> type[BaseModel]:
+    '''
+    Returns: a model holding only the given top-level fields of model_class (by name or alias)
+    '''
+    definitions = {}
+    for name, field in model_class.model_fields.items():
+        if name in fields or field.alias in fields:
+            definitions[name] = (field.annotation, field)
+    return create_model(f"{model_class.__name__}Fields", **definitions)
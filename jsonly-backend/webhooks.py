@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import socket
+import fast_json
+import logging
+import time
+from urllib.parse import urlparse
+import httpx
+from decouple import config
+import task_store
+
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', default=6, cast=int)
+WEBHOOK_INITIAL_DELAY = config('WEBHOOK_INITIAL_DELAY', default=2.0, cast=float)
+WEBHOOK_TIMEOUT = config('WEBHOOK_TIMEOUT', default=10.0, cast=float)
+WEBHOOK_SENDERS = config('WEBHOOK_SENDERS', default=4, cast=int)
+
+# Host names that never resolve to a public server
+_BLOCKED_SUFFIXES = (".internal", ".local", ".localhost", ".localdomain")
+
+_queue: asyncio.Queue | None = None
+_client: httpx.AsyncClient | None = None
+_get_signing_key = None
+_senders: list[asyncio.Task] = []
+
+
+def _is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address)
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def _resolve_host(host: str, port: int) -> list[str]:
+    infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    return [info[4][0] for info in infos]
+
+
+async def resolve_callback_url(url: str) -> tuple[str | None, str | None]:
+    '''
+    Callbacks may only go to public http(s) servers: loopback, private,
+    link-local (cloud metadata) and internal hosts are refused.
+
+    Returns: (why the URL is refused or None, an address of the host that passed the check)
+    '''
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        return "Only http(s) URLs are allowed.", None
+
+    host = parsed.hostname.lower().rstrip(".")
+    if host == "localhost" or host.endswith(_BLOCKED_SUFFIXES):
+        return "Internal hosts are not allowed.", None
+
+    try:
+        addresses = await _resolve_host(host, parsed.port or (443 if parsed.scheme == "https" else 80))
+    except (socket.gaierror, UnicodeError, ValueError):
+        return "The host could not be resolved.", None
+
+    # every address must be public, or the host could be switched to a private one
+    if not addresses or not all(_is_public_address(address) for address in addresses):
+        return "Private, loopback and link-local addresses are not allowed.", None
+    return None, addresses[0]
+
+
+async def check_callback_url(url: str) -> str | None:
+    '''
+    Returns: why the URL is refused, or None if it is allowed (see resolve_callback_url)
+    '''
+    refused, _ = await resolve_callback_url(url)
+    return refused
+
+
+def _pinned_request(url: str, address: str) -> tuple[str, dict, dict]:
+    '''
+    Returns: (the URL with its host replaced by the checked address, the Host header,
+        the request extensions), so that the connection cannot go to another address
+        the host resolves to by the time it is made (DNS rebinding)
+    '''
+    parsed = urlparse(url)
+    ip_host = f"[{address}]" if ":" in address else address
+    netloc = f"{ip_host}:{parsed.port}" if parsed.port else ip_host
+    host_header = f"{parsed.hostname}:{parsed.port}" if parsed.port else parsed.hostname
+    # TLS is negotiated and the certificate checked against the original host name
+    extensions = {"sni_hostname": parsed.hostname} if parsed.scheme == "https" else {}
+    return parsed._replace(netloc=netloc).geturl(), {"Host": host_header}, extensions
+
+
+def sign(body: bytes, timestamp: str, key: str) -> str:
+    '''
+    Args:
+        key: the webhook secret of the task's owner
+    Returns: hex HMAC-SHA256 of "<timestamp>.<body>"
+    '''
+    message = timestamp.encode() + b"." + body
+    return hmac.new(key.encode(), message, hashlib.sha256).hexdigest()
+
+
+def _schedule(item: dict, at: float):
+    wait = max(0.0, at - time.time())
+    asyncio.get_running_loop().call_later(wait, _queue.put_nowait, item)
+
+
+def enqueue(task_id: str, owner: str | None, callback_url: str):
+    '''
+    Queues the completion callback of a finished task. Delivery happens in the background.
+    '''
+    delivery_id = task_store.create_delivery(task_id, owner, callback_url)
+    _queue.put_nowait({
+        "delivery_id": delivery_id,
+        "task_id": task_id,
+        "owner": owner,
+        "callback_url": callback_url,
+        "attempts": 0,
+    })
+
+
+def _payload(task_id: str) -> bytes:
+    # read from the task store on every attempt, so queued and retried
+    # deliveries do not keep large results in memory
+    record = task_store.get_task(task_id)
+    payload = {"task_id": task_id, "status": record["status"]}
+    if record["status"] == task_store.DONE:
+        payload["result"] = record["result"]
+    else:
+        payload["error"] = record["error"]
+    return fast_json.dumps(payload).encode()
+
+
+async def _deliver(item: dict):
+    # claiming the attempt in the store makes sure that a delivery re-queued by several
+    # workers (see start) is only sent by one of them
+    if not task_store.claim_delivery(item["delivery_id"], item["attempts"], time.time() + 2 * WEBHOOK_TIMEOUT):
+        return
+    item["attempts"] += 1
+
+    error = None
+    retryable = True
+    key = await asyncio.to_thread(_get_signing_key, item["owner"]) if item["owner"] else None
+    if not key:
+        error = "No webhook secret for the task's owner"
+        retryable = False
+    elif (resolved := await resolve_callback_url(item["callback_url"]))[0] is not None:
+        # checked again at delivery time, the host may resolve differently by now
+        error = f"Callback URL refused: {resolved[0]}"
+        retryable = False
+    else:
+        # the connection goes to the address that was checked
+        url, host_header, extensions = _pinned_request(item["callback_url"], resolved[1])
+        body = _payload(item["task_id"])
+        timestamp = str(int(time.time()))
+        headers = {
+            **host_header,
+            "Content-Type": "application/json",
+            "X-Jsonly-Timestamp": timestamp,
+            "X-Jsonly-Signature": f"sha256={sign(body, timestamp, key)}",
+        }
+        try:
+            response = await _client.post(
+                url,
+                content=body,
+                headers=headers,
+                extensions=extensions,
+                timeout=WEBHOOK_TIMEOUT,
+                follow_redirects=False,  # a redirect could point to an internal host
+            )
+            if response.is_success:
+                task_store.update_delivery(item["delivery_id"], task_store.DONE)
+                return
+            error = f"HTTP {response.status_code}"
+            # client errors other than rate limiting will not fix themselves
+            retryable = response.status_code >= 500 or response.status_code in (408, 429)
+        except httpx.HTTPError as e:
+            error = f"{type(e).__name__}: {e}"
+
+    if retryable and item["attempts"] < WEBHOOK_MAX_ATTEMPTS:
+        delay = WEBHOOK_INITIAL_DELAY * 2 ** (item["attempts"] - 1)
+        logger.warning(
+            f"Webhook delivery {item['delivery_id']} failed (attempt {item['attempts']}/{WEBHOOK_MAX_ATTEMPTS}): "
+            f"{error}; retrying in {delay:.1f}s..."
+        )
+        # the next attempt time is stored so that the retry survives a restart
+        next_attempt_at = time.time() + delay
+        task_store.update_delivery(item["delivery_id"], task_store.PENDING, error, next_attempt_at)
+        _schedule(item, next_attempt_at)
+    else:
+        task_store.update_delivery(item["delivery_id"], task_store.FAILED, error)
+
+
+async def _sender():
+    while True:
+        item = await _queue.get()
+        try:
+            await _deliver(item)
+        except Exception as e:
+            logger.exception(f"Unexpected error delivering webhook {item['delivery_id']}: {e}")
+        finally:
+            _queue.task_done()
+
+
+async def start(client: httpx.AsyncClient, get_signing_key):
+    '''
+    Starts the senders and re-queues the deliveries still pending in the store,
+    e.g. retries that were scheduled when the machine was stopped.
+
+    Args:
+        client: the app's shared outbound client, used to deliver the callbacks
+        get_signing_key: function returning the webhook secret of a task owner, or None
+    '''
+    global _queue, _client, _get_signing_key, _senders
+    task_store.init_deliveries()
+    _queue = asyncio.Queue()
+    _client = client
+    _get_signing_key = get_signing_key
+    _senders = [asyncio.create_task(_sender()) for _ in range(WEBHOOK_SENDERS)]
+
+    pending = task_store.get_pending_deliveries()
+    for row in pending:
+        _schedule({
+            "delivery_id": row["delivery_id"],
+            "task_id": row["task_id"],
+            "owner": row["owner"],
+            "callback_url": row["callback_url"],
+            "attempts": row["attempts"],
+        }, row["next_attempt_at"] or 0.0)
+    if pending:
+        logger.info(f"Re-queued {len(pending)} pending webhook deliveries")
+
+
+async def stop():
+    global _client, _senders
+    for sender in _senders:
+        sender.cancel()
+    await asyncio.gather(*_senders, return_exceptions=True)
+    _senders = []
+    _client = None
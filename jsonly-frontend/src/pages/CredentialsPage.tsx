@@ -5,6 +5,7 @@ import { getFirestore, doc, getDoc } from "firebase/firestore";
 const CredentialsPage = () => {
   const [clientId, setClientId] = useState<string | null>(null);
   const [clientSecret, setClientSecret] = useState<string | null>(null);
+  const [webhookSecret, setWebhookSecret] = useState<string | null>(null);
   const [loadingClientId, setLoadingClientId] = useState(true);
   const [error, setError] = useState<string | null>(null);
   const [regenerating, setRegenerating] = useState(false);
@@ -58,16 +59,17 @@ const CredentialsPage = () => {
       setRegenerating(true);
       setError(null);
       setClientSecret(null);
+      setWebhookSecret(null);
 
       const user = getAuth().currentUser;
       if (!user) throw new Error("User not logged in");
       
-      const uid = user.uid;
+      const idToken = await user.getIdToken();
 
       const res = await fetch("http://127.0.0.1:8000/regenerate-client-secret", {
         method: "POST",
         headers: {
-          "X-User-UID": uid,
+          Authorization: `Bearer ${idToken}`,
           "Content-Type": "application/json",
         },
       });
@@ -79,6 +81,7 @@ const CredentialsPage = () => {
 
       const data = await res.json();
       setClientSecret(data.client_secret);
+      setWebhookSecret(data.webhook_secret);
     } catch (err: any) {
       setError(err.message || "Unexpected error");
     } finally {
@@ -124,6 +127,18 @@ const CredentialsPage = () => {
         </div>
       )}
 
+      {webhookSecret && (
+        <div className="mt-4">
+          <p>
+            <strong>Webhook Secret:</strong>
+          </p>
+          <code className="block bg-gray-100 text-gray-900 p-2 rounded border border-gray-300 font-mono mt-1">{webhookSecret}</code>
+          <p className="text-sm text-red-600 font-semibold">
+            ⚠️ Used to verify the signature of your callbacks. Copy it now! You won’t see it again.
+          </p>
+        </div>
+      )}
+
       {/* How to use the API Section */}
       <div className="mt-8 pt-6 border-t border-gray-700">
         <h2 className="text-xl font-bold mb-4">How to use the API</h2>